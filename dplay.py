@@ -8,7 +8,7 @@
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
-#        
+#
 # This program is distributed in the hope that it will be useful,
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
@@ -19,16 +19,16 @@
 # (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
 #
 
+import os
 import sys
 import time
+import Queue
+import struct
+import fnmatch
 import optparse
-
-parser = optparse.OptionParser()
-parser.add_option('-r', '--repeat', dest='repeat', action='store_const', const=True, default=False, help='Repeat')
-parser.add_option('-s', '--sleep', dest='sleep', default='1', help='Pause between files, in seconds')
-(options, args) = parser.parse_args()
-
-options.sleep = float(options.sleep)
+import itertools
+import threading
+from itertools import izip, groupby
 
 COLORS = [
 	(35,1),	# changed since previous
@@ -37,14 +37,6 @@ COLORS = [
 	(32,0),	# unchanged
 ]
 
-if len(args) < 1:
-	parser.error('specify one or more files')
-	sys.exit(1)
-
-def clear():
-	sys.stdout.write('\x1b[H\x1b[2J')
-	sys.stdout.flush()
-
 def restore():
 	sys.stdout.write('\x1b[!p\x1b[?3;4l\x1b[4l\x1b>')
 	sys.stdout.flush()
@@ -63,6 +55,36 @@ def colorize(inp):
 	else:
 		return colorize(True) + inp + colorize(False)
 
+def spans(new, olds):
+	'''Return runs of columns of new that differ from the same old strings.
+	@type new: string
+	@param new: string to compare
+	@type olds: list of string
+	@param olds: list of strings to compare to, most recent first; empty
+	             strings and None are not compared to
+	@rtype: list of (level, start, end)
+	@return: runs of new[start:end], level being the index of the first of
+	         olds that differs at those columns, or len(olds) if none do
+	'''
+	n = len(new)
+	if not n: return []
+	levels = None
+	# earlier levels take precedence, so start with the last one
+	for j in reversed(range(len(olds))):
+		old = olds[j]
+		if not old or old.startswith(new): continue
+		if levels is None: levels = [len(olds)] * n
+		diff = [a != b for a, b in izip(new, old)] + [True] * (n - len(old))
+		levels = [j if d else l for d, l in izip(diff, levels)]
+	if levels is None: return [(len(olds), 0, n)]
+	result = []
+	start = 0
+	for level, run in groupby(levels):
+		end = start + len(list(run))
+		result.append((level, start, end))
+		start = end
+	return result
+
 def diffie(new, olds, oldcols):
 	'''Return new with color codes for differences with old strings.
 	@type new: string
@@ -78,65 +100,220 @@ def diffie(new, olds, oldcols):
 		return colorize(new)
 	if (len(olds)+1) != len(oldcols):
 		raise ValueError('Length of colors must be one more than length of old strings')
-	lastj = None
-	newj = None
-	ret = ''
-	for i in range(len(new)):
-		newj = len(olds)
-		for j in range(len(olds)):
-			if olds[j] and i >= len(olds[j]):
-				newj=j
-				break
-			elif olds[j] and new[i] != olds[j][i]:
-				newj=j
-				break;
-		if newj != lastj:
-			ret += ansicolor(*oldcols[newj])
-			lastj = newj
-		ret += new[i]
-	ret += ansicolor(*oldcols[-1])
-	return ret
-
-
-try:
-	firsttime = True
-	while firsttime or options.repeat:
-		firsttime = False
-		oldlines=[None, None, None] # previous, one-but-previous, very-first
-		for f in args:
-			clear()
-			print '%s==== %s ====%s'%(ansicolor(37,True), f, ansicolor(*COLORS[-1]))
-			# read new file
-			f = open(f, 'r')
-			curlines = map(lambda x: x.rstrip(), f.readlines())
-			f.close()
-			# print colorized output
-			for i in range(len(curlines)):
-				oldls=[None]*len(oldlines)
-				for j in range(len(oldlines)):
-					if oldlines[j] and i < len(oldlines[j]):
-						oldls[j] = oldlines[j][i]
-				print diffie(curlines[i], oldls, COLORS)
-			# save history
-			oldlines[1] = oldlines[0]
-			oldlines[0] = curlines
-			if not oldlines[-1]:
-				oldlines[-1] = curlines
-			else:
-				for i in range(len(curlines)):
-					if i >= len(oldlines[-1]): continue
-					for j in range(len(curlines[i])):
-						if j >= len(oldlines[-1][i]):
-							oldlines[-1][i] = oldlines[-1][i]+'\0'
-						elif curlines[i][j] != oldlines[-1][i][j]:
-							oldlines[-1][i] = oldlines[-1][i][:j]+'\0'+oldlines[-1][i][j+1:]
-			# sleep a little before showing next one
-			time.sleep(options.sleep)
-
-		# clear screen for repeating
-		if options.repeat:
-			clear()
-			time.sleep(options.sleep)
-finally:
-	restore()
+	codes = [ansicolor(*x) for x in oldcols]
+	return ''.join([codes[level] + new[start:end] for level, start, end in spans(new, olds)]) + codes[-1]
+
+
+class History:
+	'''Lines of the previous, one-but-previous and first file shown. In the
+	lines of the first file, characters that changed since are \\0.'''
+
+	def __init__(self):
+		self.lines = [None, None, None]
+
+	def olds(self, i):
+		'''Return list of line i of each file, or None where there is none'''
+		return [x and i < len(x) and x[i] or None for x in self.lines]
+
+	def add(self, curlines):
+		'''Add lines of the file just shown'''
+		self.lines[1] = self.lines[0]
+		self.lines[0] = curlines
+		first = self.lines[-1]
+		if not first:
+			self.lines[-1] = curlines
+			return
+		# marked in place, like the previous lines when they're the first
+		for i in range(min(len(curlines), len(first))):
+			cur = curlines[i]
+			if first[i].startswith(cur): continue
+			first[i] = ''.join([a == b and a or '\0' for a, b in izip(first[i], cur)]) + \
+				first[i][len(cur):] + '\0' * (len(cur) - len(first[i]))
+
+def frame(name, curlines, history):
+	'''Return colorized lines of a file compared to history, with a header,
+	as list of (text, number of characters shown)'''
+	header = '==== %s ===='%name
+	lines = [('%s%s%s'%(ansicolor(37,True), header, ansicolor(*COLORS[-1])), len(header))]
+	for i in range(len(curlines)):
+		lines.append((diffie(curlines[i], history.olds(i), COLORS), len(curlines[i])))
+	history.add(curlines)
+	return lines
+
+
+def termsize(f):
+	'''Return tuple of rows and columns of terminal f, or None if unknown'''
+	try:
+		import fcntl, termios
+		rows, cols = struct.unpack('hh', fcntl.ioctl(f.fileno(), termios.TIOCGWINSZ, '\0'*4))
+	except (ImportError, AttributeError, IOError, ValueError):
+		return None
+	if rows <= 0 or cols <= 0: return None
+	return rows, cols
+
+class Screen:
+	'''Terminal showing frames of lines. Only lines that changed since the
+	previous frame are written, when the frame fits on the terminal; or
+	else the screen is cleared and all lines are written.'''
+
+	def __init__(self, out=sys.stdout):
+		self.out = out
+		self.clear()
+
+	def clear(self):
+		'''Clear screen, the next frame is written fully'''
+		self._texts = None
+		self._heights = None
+		self._size = None
+		self.out.write('\x1b[H\x1b[2J')
+		self.out.flush()
+
+	def draw(self, lines):
+		'''Show list of (text, number of characters shown)'''
+		size = termsize(self.out)
+		texts = [x[0] for x in lines]
+		heights = None
+		if size:
+			# rows taken by each line, when wider than the terminal
+			heights = [max(1, (x[1] + size[1] - 1) / size[1]) for x in lines]
+			if sum(heights) >= size[0]: heights = None
+		if heights is None or self._heights is None or size != self._size:
+			self.out.write('\x1b[H\x1b[2J' + ''.join([x + '\n' for x in texts]))
+		else:
+			out = []
+			row = 1
+			moved = False
+			for i in range(len(texts)):
+				if i >= len(self._texts) or heights[i] != self._heights[i]: moved = True
+				if moved or texts[i] != self._texts[i]:
+					out.append('\x1b[%d;1H%s'%(row, texts[i]))
+					# the cursor stays in the last column after a full row,
+					# where clearing the rest of the line would clear it
+					if lines[i][1] % size[1] or not lines[i][1]: out.append('\x1b[K')
+				row += heights[i]
+			# clear what is left of a longer previous frame
+			if moved or len(texts) < len(self._texts): out.append('\x1b[%d;1H\x1b[J'%row)
+			out.append('\x1b[%d;1H'%row)
+			self.out.write(''.join(out))
+		self.out.flush()
+		self._texts, self._heights, self._size = texts, heights, size
+
+
+def expand(args, pattern='*'):
+	'''Return list of files of arguments, in order, with the files in
+	directories matching pattern sorted by name; and set of these files'''
+	files = []
+	for arg in args:
+		if not os.path.isdir(arg):
+			files.append(arg)
+			continue
+		files += [os.path.join(arg, x) for x in sorted(os.listdir(arg))
+		          if fnmatch.fnmatch(x, pattern) and os.path.isfile(os.path.join(arg, x))]
+	return files, set(files)
+
+def watch(dirs, pattern='*', seen=None, interval=0.5):
+	'''Iterate over files that appear in directories, checking every interval
+	seconds. Files are returned once their size hasn't changed between two
+	checks, so that files still being written are not shown yet.'''
+	if seen is None: seen = set()
+	sizes = {}
+	while True:
+		ready = []
+		for d in dirs:
+			for x in os.listdir(d):
+				fn = os.path.join(d, x)
+				if fn in seen or not fnmatch.fnmatch(x, pattern): continue
+				try: size = os.path.getsize(fn)
+				except OSError: continue
+				if sizes.get(fn) == size: ready.append(fn)
+				else: sizes[fn] = size
+		for fn in sorted(ready):
+			seen.add(fn)
+			del sizes[fn]
+			yield fn
+		time.sleep(interval)
+
+
+class Prefetcher(threading.Thread):
+	'''Reads files and compares them with the ones before in the background,
+	keeping at most size frames ready to be shown. Iterate over it to get
+	the frames, see frame().'''
+
+	def __init__(self, files, size=16):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.files = files
+		self.queue = Queue.Queue(max(size, 1))
+		self.start()
+
+	def run(self):
+		try:
+			history = History()
+			for fn in self.files:
+				f = open(fn, 'r')
+				curlines = [x.rstrip() for x in f.readlines()]
+				f.close()
+				self.queue.put((frame(fn, curlines, history), None))
+		except Exception:
+			self.queue.put((None, sys.exc_info()))
+			return
+		self.queue.put((None, None))
+
+	def __iter__(self):
+		while True:
+			# waiting with a timeout keeps the main thread interruptable
+			try: lines, error = self.queue.get(True, 3600)
+			except Queue.Empty: continue
+			if error: raise error[0], error[1], error[2]
+			if lines is None: return
+			yield lines
+
+
+if __name__ == '__main__':
+
+	parser = optparse.OptionParser(usage='%prog [options] <file|dir> [<file_2|dir_2> [...]]')
+	parser.add_option('-r', '--repeat', dest='repeat', action='store_const', const=True, default=False, help='Repeat')
+	parser.add_option('-s', '--sleep', dest='sleep', default='1', help='Pause between files, in seconds')
+	parser.add_option('-f', '--follow', dest='follow', action='store_true', default=False,
+		help='After the files given, keep showing new files as they appear in the directories given')
+	parser.add_option('-m', '--match', dest='match', default='*',
+		help='Only show files in directories with names matching this pattern (default *)')
+	parser.add_option('-p', '--prefetch', dest='prefetch', type='int', default=16,
+		help='Number of files read and compared ahead of showing them (default 16)')
+	(options, args) = parser.parse_args()
+
+	options.sleep = float(options.sleep)
+
+	if len(args) < 1:
+		parser.error('specify one or more files')
+		sys.exit(1)
+	if options.follow and options.repeat:
+		parser.error('cannot repeat when following directories')
+	dirs = [x for x in args if os.path.isdir(x)]
+	if options.follow and not dirs:
+		parser.error('specify one or more directories to follow')
+
+	try:
+		screen = Screen()
+		firsttime = True
+		while firsttime or options.repeat:
+			firsttime = False
+			files, seen = expand(args, options.match)
+			if options.follow:
+				files = itertools.chain(files, watch(dirs, options.match, seen, min(options.sleep, 1.0) or 0.1))
+			# show files at a steady pace, as long as they are read in time
+			deadline = time.time()
+			for lines in Prefetcher(files, options.prefetch):
+				screen.draw(lines)
+				# sleep a little before showing next one
+				deadline += options.sleep
+				delay = deadline - time.time()
+				if delay > 0: time.sleep(delay)
+				else: deadline = time.time()
 
+			# clear screen for repeating
+			if options.repeat:
+				screen.clear()
+				time.sleep(options.sleep)
+	finally:
+		restore()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# OV-chipkaart decoder benchmarks
+#
+# Times the stages of decoding on synthetic dumps, and writes the results
+# as JSON so that runs of different versions can be compared.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import platform
+import tempfile
+import optparse
+import subprocess
+
+from ovc import *
+from ovc.util import getbits
+from ovc.synth import write_corpus
+
+
+def timed(func, repeat):
+	'''Return best time in seconds of repeat calls of func'''
+	best = None
+	for i in range(repeat):
+		t = timeit.default_timer()
+		func()
+		t = timeit.default_timer() - t
+		if best is None or t < best: best = t
+	return best
+
+def revision():
+	'''Return git revision of this tree, or None'''
+	try:
+		p = subprocess.Popen(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+			stderr=open(os.devnull, 'w'), cwd=os.path.dirname(os.path.abspath(__file__)))
+		return p.communicate()[0].strip() or None
+	except OSError:
+		return None
+
+
+def benchmarks(dumps, workdir):
+	'''Return list of (name, number of items, function) of benchmarks on dumps'''
+	slots = [(cls, sdata.tobytes()) for data in dumps for addr, sdata, cls in OvcCard(data).slots()]
+	matched = [(cls, sdata, cls._first(sdata)) for cls, sdata in slots]
+	matched = [x for x in matched if x[2] is not None]
+	fields = [(sdata, start, end) for cls, sdata, (plan, bits) in matched
+	          for fname, start, end, ftype, width in plan.fields]
+	records = [cls(sdata) for cls, sdata in slots]
+	numbers = [(r.company, r.station) for r in records if r.parsed and getattr(r, 'station', None) is not None]
+	# one instance of each class to call _parseplan() with
+	instances = dict([(cls, cls('')) for cls, sdata in slots])
+
+	def match():
+		for cls, sdata in slots: cls._first(sdata)
+	def bits():
+		for sdata, start, end in fields: getbits(sdata, start, end)
+	def typing():
+		for cls, sdata, (plan, bits) in matched: instances[cls]._parseplan(plan, bits)
+	def stations_cold():
+		stations.init()
+		for company, number in numbers: stations.title(company, number)
+	def stations_warm():
+		for company, number in numbers: stations.title(company, number)
+	def render():
+		for r in records: str(r)
+	def cards():
+		for data in dumps:
+			card = OvcCard(data)
+			str(card)
+			for r in card.records(): str(r)
+	def decode():
+		subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ovc-decode.py'),
+			'-o', os.devnull, workdir])
+
+	return [
+		('match',         len(slots),   match),
+		('getbits',       len(fields),  bits),
+		('typing',        len(matched), typing),
+		('stations_cold', len(numbers), stations_cold),
+		('stations_warm', len(numbers), stations_warm),
+		('render',        len(records), render),
+		('cards',         len(dumps),   cards),
+		('ovc-decode',    len(dumps),   decode),
+	]
+
+def compare(results, old, threshold, out=sys.stdout):
+	'''Write comparison of results with old results, return number of regressions'''
+	regressions = 0
+	out.write('%-14s %12s %12s %8s\n'%('benchmark', 'old us/item', 'new us/item', 'ratio'))
+	for name, new in sorted(results['results'].iteritems()):
+		if name not in old['results']: continue
+		a, b = old['results'][name]['us_per_item'], new['us_per_item']
+		ratio = a and b/a or 0
+		flag = ''
+		if ratio > 1+threshold:
+			flag = ' slower'
+			regressions += 1
+		out.write('%-14s %12.2f %12.2f %8.2f%s\n'%(name, a, b, ratio, flag))
+	return regressions
+
+
+if __name__ == '__main__':
+
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('-n', '--cards', dest='cards', type='int', default=500,
+		help='Number of synthetic dumps to generate (default 500)')
+	parser.add_option('-s', '--seed', dest='seed', type='int', default=1,
+		help='Seed of the random generator (default 1)')
+	parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+		help='Number of runs of each benchmark; the fastest is reported (default 3)')
+	parser.add_option('-b', '--bench', dest='bench', default=None,
+		help='Comma-separated names of benchmarks to run (default all)')
+	parser.add_option('-o', '--output', dest='output', default=None,
+		help='Write JSON results to this file instead of stdout')
+	parser.add_option('-c', '--compare', dest='compare', default=None,
+		help='Compare with JSON results of an earlier run; exits with status 1 on regressions')
+	parser.add_option('-t', '--threshold', dest='threshold', type='float', default=0.1,
+		help='Fraction a benchmark may be slower before it counts as a regression (default 0.1)')
+	parser.add_option('--write-corpus', dest='corpus', default=None,
+		help='Only write the synthetic dumps to this directory')
+	(options, args) = parser.parse_args()
+
+	if options.corpus:
+		write_corpus(options.corpus, options.cards, options.seed, stations.numbers())
+		sys.exit(0)
+
+	workdir = tempfile.mkdtemp(prefix='ovc-bench-')
+	try:
+		files = write_corpus(workdir, options.cards, options.seed, stations.numbers())
+		dumps = [open(fn, 'rb').read() for fn in files]
+		results = {
+			'revision': revision(),
+			'python':   platform.python_version(),
+			'cards':    options.cards,
+			'seed':     options.seed,
+			'repeat':   options.repeat,
+			'results':  {},
+		}
+		only = options.bench and options.bench.split(',')
+		for name, items, func in benchmarks(dumps, workdir):
+			if only and name not in only: continue
+			seconds = timed(func, options.repeat)
+			results['results'][name] = {
+				'items':       items,
+				'seconds':     round(seconds, 6),
+				'us_per_item': round(seconds/max(items, 1)*1e6, 3),
+			}
+	finally:
+		shutil.rmtree(workdir)
+
+	out = sys.stdout
+	if options.output: out = open(options.output, 'w')
+	json.dump(results, out, indent=1, sort_keys=True)
+	out.write('\n')
+	if out is not sys.stdout: out.close()
+
+	if options.compare:
+		f = open(options.compare, 'r')
+		old = json.load(f)
+		f.close()
+		# results go to stdout when not written to a file
+		out = options.output and sys.stdout or sys.stderr
+		if compare(results, old, options.threshold, out): sys.exit(1)
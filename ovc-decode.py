@@ -17,80 +17,145 @@
 # (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
 #
 import sys
+import itertools
+import optparse
+import functools
+import multiprocessing
+import multiprocessing.util
 
 from ovc import *
-from ovc.ovctypes import *
-from ovc.util import mfclassic_getsector, getbits
+from ovc import stats
+from ovc.stream import find_files, read_dumps
+from ovc.output import card_rows, TextWriter, WRITERS
+from ovc.cache import OvcDecodeCache
+from ovc.journey import OvcJourneyStream
+
+
+# successive dumps of a card only need decoding of the slots that changed
+_decoder = OvcCardDecoder()
+
+def decode(data):
+	'''Return list of output lines for an ov-chipkaart dump'''
+	card, changed = _decoder.decode(data)
+	lines = [str(card)]
+	if not lines[0]: lines = []
+	lines += [str(record) for record in card.records()]
+	return lines
+
+# journeys are paired over successive dumps of a card, in this process
+_journeys = OvcJourneyStream()
+
+def journey_lines(journeys):
+	'''Return list of output lines for journeys'''
+	return ['%10s %s'%(j.cardid is None and '-' or j.cardid, j) for j in journeys]
+
+def decode_dump(item, format='text'):
+	'''Decode (name, data, error) of a dump, return tuple of name, output, error
+	and statistics. Output is a list of lines for text and journeys, or a list
+	of rows for other formats. Statistics of the dump are returned when they are enabled,
+	so that those of worker processes can be added up.'''
+	name, data, error = item
+	if error is not None: return name, None, error, None
+	total = stats.current
+	if total is not None: stats.enable().dumps += 1
+	try:
+		if format == 'text': return name, decode(data), None, stats.current
+		if format == 'journeys':
+			return name, journey_lines(_journeys.feed(_decoder.decode(data)[0])), None, stats.current
+		return name, card_rows(name, _decoder.decode(data)[0]), None, stats.current
+	except ValueError, e:
+		return name, None, str(e), stats.current
+	finally:
+		if total is not None: stats.current = total
+
+def init_worker(cachefile=None, gatherstats=False):
+	'''Each worker process opens its own station database connection and cache'''
+	stations.con = None
+	stations.init()
+	if gatherstats: stats.enable()
+	if cachefile:
+		open_cache(cachefile)
+		# write remaining cache entries when the worker exits
+		multiprocessing.util.Finalize(None, OvcRecord.cache.close, exitpriority=10)
+
+def open_cache(cachefile):
+	'''Use persistent cache of matched templates for all records'''
+	OvcRecord.cache = OvcDecodeCache(cachefile)
 
 
 if __name__ == '__main__':
 
-	if len(sys.argv) < 2:
-		sys.stderr.write('Usage: %s <ovc_dump> [<ovc_dump_2> [...]]\n'%sys.argv[0])
-		sys.exit(1)
-
-	for fn in sys.argv[1:]:
-		inp = open(fn, 'rb')
-		data = inp.read()
-		inp.close()
-
-		if len(data) == 4096:	# mifare classic 4k
-			# card details
-			# TODO make the card an object in itself with fixed-position templates
-			# note that these data areas are not yet fully understood
-			cardid = getbits(data[0:4], 0, 4*8)
-			cardtype = OvcCardType(getbits(data[0x10:0x36], 18*8+4, 19*8))
-			validuntil = OvcDate(getbits(data[0x10:0x36], 11*8+6, 13*8+4))
-			s = 'OV-Chipkaart id %d, %s, valid until %s'%(cardid, cardtype, validuntil)
-			if cardtype==2:
-				birthdate = OvcBcdDate(getbits(mfclassic_getsector(data, 22), 14*8, 18*8))
-				s += ', birthdate %s'%birthdate
-			print s
-
-			# transactions
-			for sector in range(32, 35):
-				sdata = mfclassic_getsector(data, sector)[:-0x10]
-				for chunk in range(0, len(sdata), 0x30):
-					if ord(sdata[chunk]) == 0: continue
-					print OvcClassicTransaction(sdata[chunk:chunk+0x30])
-			for sector in range(35, 39):
-				sdata = mfclassic_getsector(data, sector)[:-0x10]
-				for chunk in range(0, len(sdata), 0x20):
-					if ord(sdata[chunk]) == 0: continue
-					print OvcClassicTransaction(sdata[chunk:chunk+0x20])
-
-			# saldo
-			class OvcSaldoTransaction(OvcRecord):
-				_fieldchars = [
-					('id',     'I',   12, OvcTransactionId),
-					('idsaldo','H',   12, OvcSaldoTransactionId),
-					('saldo',  'N',   16, OvcAmountSigned),
-					('unkU',   'U', None, FixedWidthHex),
-					('unkV',   'V', None, FixedWidthHex),
-				]
-				_templates = [
-					('20 II I0 00 00 00 80 HH H0 0N NN N0', {'I':1, 'N':1}),
-				]
-				def __str__(self):
-					s = '[saldo_%02x__] '%(ord(self.data[0]))
-					return s + OvcRecord.__str__(self)
-				
-			sdata = mfclassic_getsector(data, 39)[:-0x10]
-			for chunk in [0x90, 0xa0]:
-				if ord(sdata[chunk]) == 0: continue
-				print OvcSaldoTransaction(sdata[chunk:chunk+0x10])
-				
-
-		elif len(data) == 64:	# mifare ultralight GVB
-			# TODO card id, otp, etc.
-			for chunk in range(0x10, len(data)-0x10, 0x10):
-				# skip empty slots
-				if data[chunk:chunk+2] == '\xff\xff': continue
-				# print data
-				t = OvcULTransaction(data[chunk:chunk+0x10])
-				print t
-
-		else:
-			sys.stderr.write('%s: expected 4096 or 64 bytes of ov-chipkaart dump file\n'%fn)
-			sys.exit(2)
+	parser = optparse.OptionParser(usage='%prog [options] <ovc_dump|dir|-> [<ovc_dump_2|dir_2> [...]]')
+	parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+		help='Number of parallel decoding processes, 0 for number of processors')
+	parser.add_option('-f', '--files-from', dest='filelist', default=None,
+		help='Read names of dump files from this file, one per line ("-" for stdin)')
+	parser.add_option('--frame-size', dest='framesize', type='int', default=None,
+		help='Size of each dump in concatenated dump files (default 4096, or 64 if the file size requires so)')
+	parser.add_option('-F', '--format', dest='format', default='text',
+		choices=['text'] + sorted(WRITERS.keys()),
+		help='Output format: text, or raw field values as %s'%', '.join(sorted(WRITERS.keys())))
+	parser.add_option('-o', '--output', dest='output', default=None,
+		help='Write output to this file instead of stdout')
+	parser.add_option('--cache', dest='cache', default=None,
+		help='Keep matched templates of records in this file, to speed up decoding the same dumps again')
+	parser.add_option('--journeys', dest='journeys', action='store_true', default=False,
+		help='Show journeys made, from check-in to check-out, instead of transactions. '
+		     'Dumps of a card should be given in order of time; they are decoded in a single process.')
+	parser.add_option('--stats', dest='stats', action='store_true', default=False,
+		help='Show statistics of matched templates, unparsed records, station lookups and time spent on stderr')
+	(options, args) = parser.parse_args()
+
+	files = find_files(args, options.filelist)
+	if not files:
+		parser.error('specify one or more dump files or directories, or - for stdin')
+
+	out = sys.stdout
+	if options.output: out = open(options.output, 'wb')
+	writer = WRITERS.get(options.format, TextWriter)(out)
+
+	total = None
+	if options.stats: total = stats.enable()
+	dumps = read_dumps(files, options.framesize)
+	format = options.format
+	jobs = options.jobs or multiprocessing.cpu_count()
+	if options.journeys:
+		if format != 'text': parser.error('journeys can only be shown as text')
+		format = 'journeys'
+		jobs = 1
+	decoder = functools.partial(decode_dump, format=format)
+	pool = None
+	if jobs > 1:
+		# create the cache tables once, workers creating them at the same
+		# time would fail with "database schema has changed"
+		if options.cache: OvcDecodeCache(options.cache).close()
+		# decode in batches, so that reading ahead is bounded
+		pool = multiprocessing.Pool(jobs, init_worker, (options.cache, options.stats))
+		batches = iter(lambda: list(itertools.islice(dumps, jobs*64)), [])
+		results = itertools.chain.from_iterable(itertools.imap(lambda b: pool.map(decoder, b, 16), batches))
+	else:
+		if options.cache: open_cache(options.cache)
+		results = itertools.imap(decoder, dumps)
 
+	errors = 0
+	for name, output, error, dumpstats in results:
+		if dumpstats is not None: total.merge(dumpstats)
+		if error is not None:
+			writer.flush()
+			sys.stderr.write('%s: %s\n'%(name, error))
+			errors += 1
+			continue
+		if total is not None: t = stats.timer()
+		writer.write(output)
+		if total is not None: total.times['io'] += stats.timer() - t
+	if options.journeys:
+		# journeys held back for later dumps that didn't come
+		writer.write(journey_lines(_journeys.close()))
+	writer.close()
+	if out is not sys.stdout: out.close()
+	if pool:
+		pool.close()
+		pool.join()
+	if OvcRecord.cache: OvcRecord.cache.close()
+	if total is not None: sys.stderr.write(str(total) + '\n')
+	if errors: sys.exit(2)
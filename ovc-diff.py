@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# OV-chipkaart decoder: differences between successive dumps
+#
+# Shows what changed in each dump since the previous dump of the same
+# card: header fields, record slots with their records before and after,
+# and other data by sector. Finally the bits that changed in all dumps
+# are shown, to see which parts of a card are in use.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import sys
+import optparse
+from binascii import hexlify
+
+from ovc import *
+from ovc.diff import OvcDiffer
+from ovc.stream import find_files, read_dumps
+from ovc.output import TextWriter
+
+
+def masklines(mask):
+	'''Return lines of hexdump of the rows of 16 bytes of mask that are set'''
+	lines = []
+	for addr in range(0, len(mask), 16):
+		row = mask[addr:addr+16]
+		if not row.strip('\0'): continue
+		h = hexlify(row)
+		lines.append('%03x: %s'%(addr, ' '.join([h[i:i+2] for i in range(0, len(h), 2)])))
+	return lines
+
+
+if __name__ == '__main__':
+
+	parser = optparse.OptionParser(usage='%prog [options] <ovc_dump|dir|-> [<ovc_dump_2|dir_2> [...]]')
+	parser.add_option('-f', '--files-from', dest='filelist', default=None,
+		help='Read names of dump files from this file, one per line ("-" for stdin)')
+	parser.add_option('--frame-size', dest='framesize', type='int', default=None,
+		help='Size of each dump in concatenated dump files (default 4096, or 64 if the file size requires so)')
+	parser.add_option('-s', '--summary', dest='summary', action='store_true', default=False,
+		help='Only show the bits that changed in all dumps, not the changes of each dump')
+	parser.add_option('-m', '--mask', dest='mask', default=None,
+		help='Write the bits that changed in all dumps to this file, as a dump of each card size compared')
+	(options, args) = parser.parse_args()
+
+	files = find_files(args, options.filelist)
+	if not files:
+		parser.error('specify one or more dump files or directories, or - for stdin')
+
+	writer = TextWriter(sys.stdout)
+	differ = OvcDiffer()
+	for name, data, error in read_dumps(files, options.framesize):
+		try:
+			if error is not None: raise ValueError(error)
+			card, changes = differ.diff(data)
+		except ValueError, e:
+			writer.flush()
+			sys.stderr.write('%s: %s\n'%(name, e))
+			sys.exit(2)
+		if not changes or options.summary: continue
+		lines = ['==== %s ===='%name]
+		for change in changes:
+			lines += ['  ' + x for x in str(change).split('\n')]
+		writer.write(lines + [''])
+
+	sizes = [x for x in sorted(differ.masks, reverse=True) if any(differ.masks[x])]
+	lines = ['Compared %d dumps, %d changed'%(differ.dumps, differ.changed)]
+	for size in sizes:
+		lines += ['', '==== changed bits of %s cards: %d ===='%(LAYOUTS[size].name, differ.maskbits(size))]
+		lines += masklines(differ.mask(size))
+	writer.write(lines)
+	writer.close()
+	if options.mask:
+		f = open(options.mask, 'wb')
+		f.write(''.join([differ.mask(x) for x in sizes]))
+		f.close()
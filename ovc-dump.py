@@ -18,97 +18,137 @@
 #
 
 import sys
-import datetime
-
-
-def str2hex(data, sep=''):
-	return sep.join(map(lambda x: '%02x'%ord(x), data))
-
-def printhex(data, offset):
-	s = ''
-	addr = ''
-	for a in range(0, len(data), 8):
-		if not addr: addr = '%04x:'%(a+offset)
-		if data[a:a+8] == '\0'*8: s += ' ' + '   '*8
-		else: s += '  ' + str2hex(data[a:a+8],' ')
-		if len(s) > 125:
-			if s.strip(): print addr + s.rstrip()
-			s = ''
-			addr = ''
-	s = s.rstrip()
+import optparse
+import itertools
+import multiprocessing
+from binascii import hexlify
+
+from ovc import *
+from ovc.stream import find_files, read_dumps
+from ovc.output import TextWriter
+
+
+_zeros = '\0'*8
+_blank = ' ' + '   '*8
+
+def printhex(data, spaced, start, end, out):
+	'''Append lines of hexdump of data[start:end] to list out. spaced is the
+	hex of all data, with a space between bytes.'''
+	# zeroes only show up as blanks, or are stripped
+	if not data[start:end].strip('\0'): return
+	parts = []
+	n = 0
+	addr = None
+	for a in range(start, end, 8):
+		b = min(a+8, end)
+		if addr is None: addr = '%04x:'%a
+		if data[a:b] == _zeros: parts.append(_blank)
+		else: parts.append('  ' + spaced[3*a:3*b-1])
+		n += len(parts[-1])
+		if n > 125:
+			s = ''.join(parts)
+			if s.strip(): out.append(addr + s.rstrip())
+			parts = []
+			n = 0
+			addr = None
+	s = ''.join(parts).rstrip()
 	while s.endswith(' 00'): s=s[:-3]
-	if s.strip(): print addr + s
+	if s.strip(): out.append(addr + s)
+
+def _chunks(layout):
+	'''Return list of (start, end) of parts of a card shown on their own lines'''
+	if layout.size == 4096:
+		# general card info
+		chunks = [(0x00, 0x10), (0x10, 0x36)]
+		# info below 1k (mostly zero)
+		chunks += [(sector*0x40, sector*0x40+0x30) for sector in range(1, 32)]
+		# subscriptions and transactions; saldo is part of the trailer info
+		for start, end, chunksize, cls in layout.areas:
+			if cls is OvcSaldoTransaction: continue
+			chunks += [(addr, addr+chunksize) for addr in range(start, end-chunksize+1, chunksize)]
+	else:
+		# general card info
+		chunks = [(0x00, 0x10)]
+		for start, end, chunksize, cls in layout.areas:
+			chunks += [(addr, min(addr+chunksize, layout.size)) for addr in range(start, end, chunksize)]
+	return chunks
+
+'''Parts of each card layout shown, by dump size'''
+CHUNKS = dict([(size, _chunks(layout)) for size, layout in LAYOUTS.iteritems()])
+'''Parts of the trailer of mifare classic 4k cards, after its leading zeroes'''
+TRAILER = [(0xf50, 0xf70), (0xf70, 0xf90), (0xf90, 0xfa0), (0xfa0, 0xfb0), (0xfb0, 0xfd0), (0xfd0, 0xff0)]
+
+def hexdump(data):
+	'''Return list of lines of hexdump of a card'''
+	if len(data) not in CHUNKS:
+		raise ValueError('expected 4096 or 64 bytes of ov-chipkaart dump file')
+	h = hexlify(data)
+	spaced = ' '.join(itertools.imap(''.join, itertools.izip(h[0::2], h[1::2])))
+	lines = []
+	for start, end in CHUNKS[len(data)]:
+		printhex(data, spaced, start, end, lines)
+	if len(data) == 4096:
+		# trailer info
+		addr = 0xf00
+		while addr < 0xf50 and data[addr]=='\0': addr+=1
+		if addr<0xf50: printhex(data, spaced, addr, 0xf50, lines)
+		for start, end in TRAILER:
+			printhex(data, spaced, start, end, lines)
+	return lines
+
+def dump_item(item):
+	'''Return tuple of name, hexdump lines and error of (name, data, error)'''
+	name, data, error = item
+	if error is not None: return name, None, error
+	try: return name, hexdump(data), None
+	except ValueError, e: return name, None, str(e)
 
 
 if __name__ == '__main__':
 
-	if len(sys.argv) < 2:
+	parser = optparse.OptionParser(usage='%prog [options] <ovc_dump|dir|-> [<ovc_dump_2|dir_2> [...]]')
+	parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+		help='Number of parallel processes, 0 for number of processors')
+	parser.add_option('-f', '--files-from', dest='filelist', default=None,
+		help='Read names of dump files from this file, one per line ("-" for stdin)')
+	parser.add_option('--frame-size', dest='framesize', type='int', default=None,
+		help='Size of each dump in concatenated dump files (default 4096, or 64 if the file size requires so)')
+	parser.add_option('-o', '--output', dest='output', default=None,
+		help='Write output to this file instead of stdout')
+	(options, args) = parser.parse_args()
+
+	files = find_files(args, options.filelist)
+	if not files:
 		sys.stderr.write('Usage: %s <ovc_dump> [<ovc_dump_2> [...]]\n'%sys.argv[0])
 		sys.exit(1)
 
+	out = sys.stdout
+	if options.output: out = open(options.output, 'wb')
+	writer = TextWriter(out)
+	dumps = read_dumps(files, options.framesize)
+	jobs = options.jobs or multiprocessing.cpu_count()
+	pool = None
+	if jobs > 1:
+		# dump in batches, so that reading ahead is bounded
+		pool = multiprocessing.Pool(jobs)
+		batches = iter(lambda: list(itertools.islice(dumps, jobs*64)), [])
+		results = itertools.chain.from_iterable(itertools.imap(lambda b: pool.map(dump_item, b, 16), batches))
+	else:
+		results = itertools.imap(dump_item, dumps)
+
+	# dumps are separated by an empty line; the first error ends the output
 	isfirst = True
-	for fn in sys.argv[1:]:
-		if not isfirst: print
+	for name, lines, error in results:
+		if not isfirst: writer.write([''])
 		isfirst = False
-		inp = open(fn, 'rb')
-		data = inp.read()
-		inp.close()
-
-		if len(data) == 4096:	# mifare classic 4k
-			# general card info
-			printhex(data[0x00:0x10], 0);
-			printhex(data[0x10:0x36], 0x10);
-
-			# info below 1k (mostly zero)
-			for sector in range(1, 32):
-				addr = sector*0x40
-				length = 0x30
-				chunksize = 0x30
-
-				for tr_offs in range(0, length, chunksize):
-					if tr_offs+chunksize <= length:
-						printhex(data[addr+tr_offs:addr+tr_offs+chunksize], addr+tr_offs)
-
-			# subscriptions
-			for sector in range(32, 35):
-				addr = 0x800 + (sector-32)*0x100
-				length = 0xf0
-				chunksize = 0x30
-
-				for tr_offs in range(0, length, chunksize):
-					if tr_offs+chunksize <= length:
-						printhex(data[addr+tr_offs:addr+tr_offs+chunksize], addr+tr_offs)
-
-			# transactions
-			for sector in range(35, 39):
-				addr = 0x800 + (sector-32)*0x100
-				length = 0xf0
-				chunksize = 0x20
-				
-				for tr_offs in range(0, length, chunksize):
-					if tr_offs+chunksize <= length:
-						printhex(data[addr+tr_offs:addr+tr_offs+chunksize], addr+tr_offs)
-
-			# trailer info
-			addr=0xf00
-			while data[addr]=='\0': addr+=1
-			if addr<0xf50: printhex(data[addr:0xf50], addr)
-			printhex(data[0xf50:0xf70], 0xf50)
-			printhex(data[0xf70:0xf90], 0xf70)
-			printhex(data[0xf90:0xfa0], 0xf90)
-			printhex(data[0xfa0:0xfb0], 0xfa0)
-			printhex(data[0xfb0:0xfd0], 0xfb0)
-			printhex(data[0xfd0:0xff0], 0xfd0)
-
-		elif len(data) == 64:	# mifare ultralight GVB
-			# general card info
-			printhex(data[0x00:0x10], 0);
-
-			for chunk in range(0x10, len(data)-0x10, 0x10):
-                            printhex(data[chunk:chunk+0x10], chunk)
-
-		else:
-			sys.stderr.write('%s: expected 4096 or 64 bytes of ov-chipkaart dump file\n'%fn)
+		if error is not None:
+			writer.close()
+			sys.stderr.write('%s: %s\n'%(name, error))
+			if pool: pool.terminate()
 			sys.exit(2)
-
-
+		writer.write(lines)
+	writer.close()
+	if out is not sys.stdout: out.close()
+	if pool:
+		pool.close()
+		pool.join()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#
+# OV-chipkaart decoder: load decoded dumps into a database
+#
+# Decodes dumps in batches and stores their cards and transactions in an
+# sqlite database with indexes for analysis. Dumps already in the
+# database are skipped, so ingesting the same files again is harmless.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+import os
+import sys
+import hashlib
+import sqlite3
+import itertools
+import optparse
+import multiprocessing
+from binascii import hexlify
+
+from ovc import *
+from ovc.stream import find_files, read_dumps
+from ovc.output import COLUMNS, RECORDKINDS, plain
+
+'''Field columns of transactions: those of all record classes'''
+FIELDS = COLUMNS[COLUMNS.index('template')+1:COLUMNS.index('data')]
+
+createsql = '''
+CREATE TABLE IF NOT EXISTS cards (
+	id          INTEGER PRIMARY KEY,
+	layout      TEXT NOT NULL,		-- classic or ultralight
+	uid         TEXT NOT NULL,		-- first four bytes of the dump, in hex
+	cardid      INTEGER,
+	cardtype    INTEGER,
+	validuntil  TEXT,
+	birthdate   TEXT,
+	UNIQUE (layout, uid)
+);
+CREATE TABLE IF NOT EXISTS dumps (
+	id          INTEGER PRIMARY KEY,
+	checksum    TEXT NOT NULL UNIQUE,	-- sha1 of dump contents
+	name        TEXT NOT NULL,		-- file (and frame) it was first ingested from
+	card        INTEGER REFERENCES cards (id),
+	error       TEXT			-- why the dump could not be decoded, if so
+);
+-- id is the transaction id on the card, rows are numbered by rowid
+CREATE TABLE IF NOT EXISTS transactions (
+	card        INTEGER NOT NULL REFERENCES cards (id),
+	dump        INTEGER NOT NULL REFERENCES dumps (id),	-- first dump it was on
+	address     INTEGER NOT NULL,	-- of the slot in that dump
+	digest      TEXT NOT NULL,		-- sha1 of record data
+	record      TEXT NOT NULL,		-- kind of record
+	template    INTEGER NOT NULL,
+	%s,
+	UNIQUE (card, digest)
+);
+CREATE INDEX IF NOT EXISTS cards_cardid ON cards (cardid);
+CREATE INDEX IF NOT EXISTS dumps_card ON dumps (card);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (date);
+CREATE INDEX IF NOT EXISTS transactions_company ON transactions (company);
+CREATE INDEX IF NOT EXISTS transactions_station ON transactions (company, station);
+'''%',\n\t'.join(['%-11s %s'%(x, x in ('date', 'validfrom', 'validto') and 'TEXT' or 'NUMERIC') for x in FIELDS])
+
+'''Transactions with their card and station'''
+viewsql = '''
+CREATE VIEW IF NOT EXISTS transactions_view AS
+	SELECT	t.*, c.cardid, c.cardtype, s.title AS stationtitle, s.lon, s.lat
+	FROM	transactions t
+		JOIN cards c ON c.id = t.card
+		LEFT JOIN stations_data s ON s.company = t.company AND s.ovcid = t.station
+'''
+
+'''Station table, when there is no station database to copy it from'''
+stationsql = '''
+CREATE TABLE IF NOT EXISTS stations_data (
+	company INT NOT NULL, ovcid INT NOT NULL, name VARCHAR(50), city VARCHAR(50),
+	longname VARCHAR(120), haltenr INT, zone INT, lon FLOAT, lat FLOAT,
+	title VARCHAR(170), source VARCHAR(50), PRIMARY KEY (company, ovcid)
+);
+'''
+
+
+def dbconnect(filename):
+	'''Open store, creating its tables when needed'''
+	con = sqlite3.connect(filename)
+	con.isolation_level = None
+	con.executescript('''
+		PRAGMA synchronous = NORMAL;
+		PRAGMA cache_size = -65536;
+	''')
+	con.executescript(stationsql)
+	con.executescript(createsql)
+	con.execute(viewsql)
+	return con
+
+def copy_stations(con, stationdb):
+	'''Replace stations_data with that of the station database'''
+	con.execute('ATTACH DATABASE ? AS st', (stationdb,))
+	try:
+		row = con.execute("SELECT sql FROM st.sqlite_master WHERE name='stations_data'").fetchone()
+		if not row: return False
+		con.execute('BEGIN')
+		con.execute('DROP VIEW IF EXISTS transactions_view')
+		con.execute('DROP TABLE stations_data')
+		con.execute(row[0])
+		con.execute('INSERT INTO stations_data SELECT * FROM st.stations_data')
+		con.execute(viewsql)
+		con.execute('COMMIT')
+		return True
+	finally:
+		con.execute('DETACH DATABASE st')
+
+def value(x):
+	'''Return plain field value that fits in an sqlite column; numbers of
+	more than 63 bits are stored as hex strings'''
+	x = plain(x)
+	if isinstance(x, (int, long)) and not -(1<<63) <= x < (1<<63): return '%x'%x
+	return x
+
+def decode_dump(item):
+	'''Decode (name, checksum, data, error) of a dump, return tuple of name,
+	checksum, card key, card values, transaction rows and error. Only plain
+	values are returned, so that worker processes can send them.'''
+	name, checksum, data, error = item
+	if error is not None: return name, checksum, None, None, None, error
+	try:
+		card = OvcCard(data)
+		header = tuple([value(getattr(card, x)) for x in ('cardid', 'cardtype', 'validuntil', 'birthdate')])
+		rows = []
+		for addr, sdata, cls in card.slots():
+			record = cls(sdata)
+			if not record.parsed: continue
+			fields = dict(record.fields())
+			rows.append((addr, hashlib.sha1(sdata).hexdigest(), RECORDKINDS.get(cls, cls.__name__),
+				record.template) + tuple([value(fields.get(x)) for x in FIELDS]))
+		layout, uid = card.key()
+		return name, checksum, (layout, hexlify(uid)), header, rows, None
+	except ValueError, e:
+		return name, checksum, None, None, None, str(e)
+
+
+class OvcIngest:
+	'''Loads decoded dumps into the store, a batch at a time in a single
+	transaction. Dumps are identified by their checksum and transactions
+	by the checksum of their data on a card, so each is stored once.'''
+
+	def __init__(self, con):
+		self.con = con
+		self.cards = dict([((layout, uid), id) for id, layout, uid in con.execute('SELECT id, layout, uid FROM cards')])
+		self.checksums = set([x[0] for x in con.execute('SELECT checksum FROM dumps')])
+		self.dumps = 0
+		self.transactions = 0
+		self.errors = 0
+		self._insert = 'INSERT OR IGNORE INTO transactions (card, dump, address, digest, record, template, %s) VALUES (%s)'%(
+			', '.join(FIELDS), ', '.join(['?']*(len(FIELDS)+6)))
+
+	def new(self, dumps):
+		'''Iterate over (name, checksum, data, error) of dumps not in the store'''
+		for name, data, error in dumps:
+			checksum = None
+			if data is not None:
+				checksum = hashlib.sha1(data).hexdigest()
+				if checksum in self.checksums: continue
+				# same dump twice in this run
+				self.checksums.add(checksum)
+			yield name, checksum, data, error
+
+	def load(self, results):
+		'''Store list of results of decode_dump(), return errors as (name, error)'''
+		cur = self.con.cursor()
+		errors = []
+		cur.execute('BEGIN')
+		try:
+			for name, checksum, key, header, rows, error in results:
+				if checksum is None:
+					errors.append((name, error))
+					continue
+				cardid = None
+				if key is not None:
+					cardid = self.cards.get(key)
+					if cardid is None:
+						cur.execute('INSERT INTO cards (layout, uid, cardid, cardtype, validuntil, birthdate) VALUES (?,?,?,?,?,?)', key + header)
+						cardid = self.cards[key] = cur.lastrowid
+				cur.execute('INSERT INTO dumps (checksum, name, card, error) VALUES (?,?,?,?)', (checksum, name, cardid, error))
+				dumpid = cur.lastrowid
+				if error is not None:
+					errors.append((name, error))
+					continue
+				before = self.con.total_changes
+				cur.executemany(self._insert, [(cardid, dumpid) + row for row in rows])
+				self.transactions += self.con.total_changes - before
+				self.dumps += 1
+			cur.execute('COMMIT')
+		except:
+			cur.execute('ROLLBACK')
+			raise
+		self.errors += len(errors)
+		return errors
+
+
+if __name__ == '__main__':
+
+	parser = optparse.OptionParser(usage='%prog [options] <database> <ovc_dump|dir|-> [<ovc_dump_2|dir_2> [...]]')
+	parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+		help='Number of parallel decoding processes, 0 for number of processors')
+	parser.add_option('-b', '--batch-size', dest='batchsize', type='int', default=1024,
+		help='Number of dumps decoded and stored in each transaction (default 1024)')
+	parser.add_option('-f', '--files-from', dest='filelist', default=None,
+		help='Read names of dump files from this file, one per line ("-" for stdin)')
+	parser.add_option('--frame-size', dest='framesize', type='int', default=None,
+		help='Size of each dump in concatenated dump files (default 4096, or 64 if the file size requires so)')
+	parser.add_option('--stations', dest='stations', default=None,
+		help='Station database to copy stations_data from (default that of stations/createdb.py)')
+	parser.add_option('-q', '--quiet', dest='quiet', action='store_true', default=False,
+		help='Don\'t show the number of dumps and transactions stored')
+	(options, args) = parser.parse_args()
+
+	if not args:
+		parser.error('specify the database to store dumps in')
+	files = find_files(args[1:], options.filelist)
+	if not files:
+		parser.error('specify one or more dump files or directories, or - for stdin')
+
+	con = dbconnect(args[0])
+	stationdb = options.stations or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stations', 'stations.sqlite')
+	if os.path.exists(stationdb): copy_stations(con, stationdb)
+	elif options.stations: parser.error('station database not found: %s'%stationdb)
+
+	ingest = OvcIngest(con)
+	dumps = ingest.new(read_dumps(files, options.framesize))
+	batches = iter(lambda: list(itertools.islice(dumps, options.batchsize)), [])
+	jobs = options.jobs or multiprocessing.cpu_count()
+	pool = None
+	if jobs > 1:
+		pool = multiprocessing.Pool(jobs)
+		results = itertools.imap(lambda b: pool.map(decode_dump, b, 16), batches)
+	else:
+		results = itertools.imap(lambda b: map(decode_dump, b), batches)
+
+	for batch in results:
+		for name, error in ingest.load(batch):
+			sys.stderr.write('%s: %s\n'%(name, error))
+	if pool:
+		pool.close()
+		pool.join()
+	con.execute('ANALYZE')
+	con.close()
+	if not options.quiet:
+		print 'Stored %d dumps, %d new transactions'%(ingest.dumps, ingest.transactions)
+	if ingest.errors: sys.exit(2)
@@ -20,3 +20,4 @@ import stations
 from ovctypes import *
 from ovcrecord import *
 
+from card import *
@@ -0,0 +1,170 @@
+#
+# OV-chipkaart decoder: columnar batch decoding
+#
+# Decodes many records at once into numpy arrays, one per field; this
+# requires numpy, which is not needed for the rest of the package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+from binascii import hexlify
+import numpy
+
+from util import tobytes, BCD
+from ovctypes import *
+from ovcrecord import OvcClassicTransaction
+from card import OvcCard
+
+
+def _datetime(x):
+	return numpy.datetime64(OvcDatetime.epoch, 'm') + \
+		(x>>11).astype('timedelta64[D]') + (x&((1<<11)-1)).astype('timedelta64[m]')
+
+def _date(x):
+	return numpy.datetime64(OvcDate.epoch, 'D') + x.astype('timedelta64[D]')
+
+'''BCD table as array, -1 for bytes that aren't binary-coded decimal'''
+_bcd = numpy.array([x is None and -1 or x for x in BCD], numpy.int64)
+
+def _bcddate(x):
+	x = x.astype(numpy.int64)
+	digits = [_bcd[(x>>shift) & 0xff] for shift in (0, 8, 16, 24)]
+	day, month, year = digits[0], digits[1], digits[3]*100 + digits[2]
+	months = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (month - 1).astype('timedelta64[M]')
+	d = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+	# no year is no date, like invalid digits and days past the end of the month
+	valid = (numpy.array(digits) >= 0).all(0) & (year > 0) & (month > 0) & (month <= 12) & (day > 0)
+	valid &= d.astype('datetime64[M]') == months
+	return numpy.where(valid, d, numpy.datetime64('NaT'))
+
+'''Conversions of raw field values to numpy values, by field type.
+Field types not listed here are returned as raw numbers.'''
+converters = {
+	OvcDatetime:     _datetime,
+	OvcDate:         _date,
+	OvcBcdDate:      _bcddate,
+	OvcAmount:       lambda x: x/100.0,
+	OvcAmountSigned: lambda x: (x.astype(numpy.int64) - (1<<15))/100.0,
+}
+
+
+class OvcBatch:
+	'''Fields of many records of a single record class, decoded at once.
+
+	Records are grouped by the template they match. Each field of a group
+	is extracted for all its records at once into a numpy array of raw
+	values (the number a field type is constructed from), which can be
+	converted to dates and amounts with column().'''
+
+	def __init__(self, slots, recordclass=OvcClassicTransaction, fields=None):
+		'''Decode slots, a list of binary strings or a 2-d uint8 array.
+		When fields is given, only those fields are extracted.'''
+		self.recordclass = recordclass
+		index = recordclass._compile()
+		data = _toarray(slots, index.width)
+		self.n = len(data)
+		# length of data without trailing zeroes
+		nonzero = data[:,::-1] != 0
+		datalen = numpy.where(nonzero.any(1), data.shape[1] - nonzero.argmax(1), 0)
+
+		'''index of matched template for each record, -1 when unparsed'''
+		self.template = numpy.empty(self.n, numpy.int16)
+		self.template.fill(-1)
+		'''dict of template index to tuple of rows and dict of fieldname to array'''
+		self.groups = {}
+		for plan in index.plans:
+			rows = numpy.flatnonzero(self.template < 0)
+			if not len(rows): break
+			sub = data[rows, :plan.size]
+			mask = _tobytes(plan.mask, plan.size)
+			value = _tobytes(plan.value, plan.size)
+			match = ((sub & mask) == value).all(1) & (datalen[rows] <= plan.length)
+			rows, sub = rows[match], sub[match]
+			if not len(rows): continue
+			self.template[rows] = plan.index
+			values = {}
+			for fname, start, end, ftype, width in plan.fields:
+				if fields is not None and fname not in fields: continue
+				values[fname] = _extract(sub, start, end)
+			self.groups[plan.index] = (rows, values)
+
+	def column(self, fname, raw=False):
+		'''Return field of all records as numpy masked array, masked where
+		the record's template doesn't have this field. Dates and amounts
+		are converted, unless raw is set.'''
+		ftype = [x[3] for x in self.recordclass._fieldchars if x[0]==fname][0]
+		dtype = numpy.uint64
+		for rows, values in self.groups.values():
+			if fname in values: dtype = values[fname].dtype
+		col = numpy.ma.masked_all(self.n, dtype)
+		for rows, values in self.groups.values():
+			if fname in values: col[rows] = values[fname]
+		if not raw and ftype in converters:
+			converted = converters[ftype](col.data)
+			col = numpy.ma.array(converted, mask=numpy.ma.getmaskarray(col))
+		return col
+
+	def parsed(self):
+		'''Return boolean array of records matching a template'''
+		return self.template >= 0
+
+
+def _toarray(slots, width):
+	'''Return slots as 2-d uint8 array of at least width columns'''
+	if isinstance(slots, numpy.ndarray):
+		data = slots
+	else:
+		length = max([width] + [len(s) for s in slots])
+		data = ''.join([tobytes(s) + '\0'*(length-len(s)) for s in slots])
+		data = numpy.frombuffer(data, numpy.uint8).reshape(len(slots), length)
+	if data.shape[1] < width:
+		data = numpy.hstack([data, numpy.zeros((len(data), width-data.shape[1]), numpy.uint8)])
+	return data
+
+def _tobytes(x, size):
+	'''Return number as uint8 array of size bytes (msb first)'''
+	return numpy.frombuffer(('%0*x'%(size*2, x)).decode('hex'), numpy.uint8)
+
+def _extract(data, start, end):
+	'''Return numbers at bit positions of each row of uint8 array (msb first)'''
+	first, last = start/8, (end-1)/8
+	if last-first >= 8:
+		# wider than 64 bits, use Python numbers
+		mask = (1L<<(end-start))-1
+		return numpy.array([(long(hexlify(r), 16) >> (8*(last+1)-end)) & mask
+		                    for r in data[:, first:last+1]], object)
+	val = numpy.zeros(len(data), numpy.uint64)
+	for byte in range(first, last+1):
+		val = (val << numpy.uint64(8)) | data[:, byte]
+	val >>= numpy.uint64(8*(last+1)-end)
+	return val & numpy.uint64((1L<<(end-start))-1)
+
+
+def record_slots(dumps, recordclass=OvcClassicTransaction):
+	'''Return non-empty slots of records of recordclass in dumps, as tuple of
+	a list of slot data and an array of (dump, address)'''
+	slots = []
+	positions = []
+	for i, data in enumerate(dumps):
+		for addr, sdata, cls in OvcCard(data).slots():
+			if cls is not recordclass: continue
+			slots.append(sdata)
+			positions.append((i, addr))
+	return slots, numpy.array(positions, numpy.uint32).reshape(len(positions), 2)
+
+def classic_transaction_slots(dumps):
+	'''Return transaction slots of mifare classic 4k dumps, skipping empty
+	slots, as tuple of a list of slot data and an array of (dump, address)'''
+	return record_slots(dumps, OvcClassicTransaction)
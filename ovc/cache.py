@@ -0,0 +1,166 @@
+#
+# OV-chipkaart decoder: persistent cache of matched templates
+#
+# Records are stored by the hash of their data, so that re-running the
+# decoder over an archive needn't match slots that were seen before.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import hashlib
+import sqlite3
+
+createsql = '''
+CREATE TABLE IF NOT EXISTS classes (
+	name        TEXT PRIMARY KEY,
+	fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+	fingerprint TEXT NOT NULL,
+	digest      BLOB NOT NULL,
+	template    INTEGER NOT NULL,
+	bits        TEXT,
+	PRIMARY KEY (fingerprint, digest)
+);
+'''
+
+
+def fingerprint(cls):
+	'''Return fingerprint of the templates and fields of a record class'''
+	fields = [(fname, fchar, flen, getattr(ftype, '__name__', repr(ftype)))
+	          for fname, fchar, flen, ftype in cls._fieldchars]
+	return hashlib.sha1(repr((cls.__module__, cls.__name__, cls._templates, fields))).hexdigest()
+
+
+class OvcDecodeCache:
+	'''Cache of the template each record matches, kept in an sqlite database.
+
+	Entries are keyed by the sha1 hash of the record data and the fingerprint
+	of the record class' templates and fields, and hold the index of the
+	matched template and the record as a number (or no template when the
+	record is unparsed). Field values follow from these without matching,
+	and are still converted by their field types, so changes to field types
+	don't need invalidation. When the templates or fields of a class change,
+	the entries of its old fingerprint are removed.
+
+	Entries are looked up in the database one slot at a time, or for all
+	slots of a card with prefetch(); classes without entries when first
+	used are not looked up at all. Entries used recently are kept in
+	memory: at most size in a dict of new ones, which becomes the dict of
+	old ones when full, so memory use doesn't grow with the database.
+	New entries are written in blocks of flushsize, and on flush() or
+	close(). Assign an instance to OvcRecord.cache to use it.'''
+
+	def __init__(self, filename, flushsize=4096, size=65536):
+		self.filename = filename
+		self.flushsize = flushsize
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self._con = sqlite3.connect(filename, timeout=60)
+		self._con.executescript(createsql)
+		# fingerprint by class, checked against the database on first use
+		self._fingerprints = {}
+		# fingerprints without entries in the database on first use, which
+		# needn't be looked up there
+		self._empty = set()
+		# (template, bits) by (fingerprint, digest), False for entries known
+		# not to be in the database
+		self._entries = {}
+		self._old = {}
+		self._new = []
+
+	def _fingerprint(self, cls):
+		'''Return fingerprint of class, removing entries of its old fingerprint'''
+		fp = fingerprint(cls)
+		name = '%s.%s'%(cls.__module__, cls.__name__)
+		cur = self._con.cursor()
+		cur.execute('SELECT fingerprint FROM classes WHERE name=?', (name,))
+		row = cur.fetchone()
+		if not row or row[0] != fp:
+			if row: cur.execute('DELETE FROM records WHERE fingerprint=?', (row[0],))
+			cur.execute('INSERT OR REPLACE INTO classes (name, fingerprint) VALUES (?,?)', (name, fp))
+			self._con.commit()
+		cur.execute('SELECT 1 FROM records WHERE fingerprint=? LIMIT 1', (fp,))
+		if not cur.fetchone(): self._empty.add(fp)
+		self._fingerprints[cls] = fp
+		return fp
+
+	def prefetch(self, slots):
+		'''Look up entries of list of (record class, data) in the database at
+		once, so that matching these records needn't query it one by one'''
+		keys = {}
+		for cls, data in slots:
+			fp = self._fingerprints.get(cls) or self._fingerprint(cls)
+			if fp in self._empty: continue
+			key = (fp, hashlib.sha1(data).digest())
+			if key not in self._entries and key not in self._old: keys.setdefault(fp, []).append(key[1])
+		for fp, digests in keys.iteritems():
+			cur = self._con.execute('SELECT digest, template, bits FROM records WHERE fingerprint=? AND digest IN (%s)'%
+				','.join(['?']*len(digests)), [fp] + map(sqlite3.Binary, digests))
+			found = dict([(str(digest), (template, bits)) for digest, template, bits in cur])
+			# digests not found are marked, so they aren't looked up again
+			for digest in digests: self._put((fp, digest), found.get(digest, False))
+
+	def _get(self, key):
+		'''Return entry by key from memory or else the database, or None'''
+		entry = self._entries.get(key)
+		if entry is not None: return entry or None
+		entry = self._old.get(key)
+		if entry is None:
+			if key[0] in self._empty: return None
+			row = self._con.execute('SELECT template, bits FROM records WHERE fingerprint=? AND digest=?',
+				(key[0], sqlite3.Binary(key[1]))).fetchone()
+			if row is None: return None
+			entry = tuple(row)
+		self._put(key, entry)
+		return entry or None
+
+	def _put(self, key, entry):
+		if len(self._entries) >= self.size:
+			self._old = self._entries
+			self._entries = {}
+		self._entries[key] = entry
+
+	def match(self, cls, data):
+		'''Return (plan, record number) of the first template of cls matching
+		data, or None; like OvcRecord._first(), but from the cache when possible'''
+		fp = self._fingerprints.get(cls) or self._fingerprint(cls)
+		key = (fp, hashlib.sha1(data).digest())
+		entry = self._get(key)
+		if entry is not None:
+			self.hits += 1
+			template, bits = entry
+			if template < 0: return None
+			return cls._compile().plans[template], long(bits, 16)
+		self.misses += 1
+		match = cls._first(data)
+		if match is None: entry = (-1, None)
+		else: entry = (match[0].index, '%x'%match[1])
+		self._put(key, entry)
+		self._new.append((fp, sqlite3.Binary(key[1])) + entry)
+		if len(self._new) >= self.flushsize: self.flush()
+		return match
+
+	def flush(self):
+		'''Write new entries to the database'''
+		if not self._new: return
+		self._con.executemany('INSERT OR REPLACE INTO records (fingerprint, digest, template, bits) VALUES (?,?,?,?)', self._new)
+		self._con.commit()
+		self._new = []
+
+	def close(self):
+		self.flush()
+		self._con.close()
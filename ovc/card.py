@@ -0,0 +1,182 @@
+#
+# OV-chipkaart decoder: card dumps
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#        
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+from collections import OrderedDict
+
+from util import getbits, tobytes
+from ovctypes import *
+from ovcrecord import *
+
+
+class OvcLayout:
+	'''Layout of a card type, computed once from its description.
+
+	header is a list of (fieldname, start bit, end bit, type, condition),
+	type may be None for a plain number; condition is None or a tuple of
+	(fieldname, value) for fields only present when another field has that
+	value. areas is a list of (start address, end address, slot size,
+	record class): each area is divided into slots, of which the last one
+	may be shorter. Slots starting with empty contain no record.'''
+
+	def __init__(self, name, size, header, areas, empty):
+		self.name = name
+		self.size = size
+		self.header = dict([(x[0], x[1:]) for x in header])
+		self.areas = areas
+		self.empty = empty
+		'''tuple of (start address, end address, record class) of all slots'''
+		self.slots = tuple([(addr, min(addr+slotsize, end), cls)
+		                    for start, end, slotsize, cls in areas
+		                    for addr in range(start, end, slotsize)])
+		'''tuple of (start address, end address, slots) of each area'''
+		self.areaslots = tuple([(start, end, tuple([x for x in self.slots if start <= x[0] < end]))
+		                        for start, end, slotsize, cls in areas])
+
+
+def _sectors(first, last, slotsize, cls):
+	'''Return areas of mifare classic 4k sectors without their trailer'''
+	return [(0x800 + (s-32)*0x100, 0x8f0 + (s-32)*0x100, slotsize, cls) for s in range(first, last+1)]
+
+'''Card layouts by dump size'''
+LAYOUTS = {
+	4096: OvcLayout('classic', 4096,
+		# note that these data areas are not yet fully understood
+		header = [
+			('cardid',     0x00*8,          0x04*8,          None,         None),
+			('cardtype',   0x10*8+18*8+4,   0x10*8+19*8,     OvcCardType,  None),
+			('validuntil', 0x10*8+11*8+6,   0x10*8+13*8+4,   OvcDate,      None),
+			('birthdate',  0x580*8+14*8,    0x580*8+18*8,    OvcBcdDate,   ('cardtype', 2)),
+		],
+		areas = _sectors(32, 34, 0x30, OvcClassicTransaction) +
+		        _sectors(35, 38, 0x20, OvcClassicTransaction) + [
+			# saldo
+			(0xf90, 0xfb0, 0x10, OvcSaldoTransaction),
+		],
+		empty = '\0'),
+	# mifare ultralight GVB
+	# TODO card id, otp, etc.
+	64: OvcLayout('ultralight', 64,
+		header = [],
+		areas = [
+			(0x10, 0x30, 0x10, OvcULTransaction),
+		],
+		empty = '\xff\xff'),
+}
+
+
+class OvcCard:
+	'''Dump of an OV-chipkaart, mifare classic 4k or ultralight.
+	Header fields are decoded when first accessed, records when iterated;
+	decoded records are kept by slot address.'''
+
+	'''Header fields of all layouts, None when not on a card'''
+	_headerfields = frozenset([name for layout in LAYOUTS.values() for name in layout.header])
+
+	def __init__(self, data):
+		self.data = data
+		self.layout = LAYOUTS.get(len(data))
+		if self.layout is None:
+			raise ValueError('expected 4096 or 64 bytes of ov-chipkaart dump file')
+		self._records = {}
+
+	def __getattr__(self, name):
+		# decode header field on first access
+		if name not in self._headerfields: raise AttributeError(name)
+		value = None
+		if name in self.layout.header:
+			start, end, ftype, condition = self.layout.header[name]
+			if condition is None or getattr(self, condition[0]) == condition[1]:
+				value = getbits(self.data, start, end)
+				if ftype is not None: value = ftype(value)
+		self.__dict__[name] = value
+		return value
+
+	def key(self):
+		'''Return key identifying the card in dumps of it: card type and id
+		(the first four bytes, also for cards without decoded card id)'''
+		return (self.layout.name, tobytes(self.data[0:4]))
+
+	def slots(self):
+		'''Iterate over (address, data, record class) of non-empty slots.
+		Slot data is a memoryview of the card's data.'''
+		data, empty = memoryview(self.data), self.layout.empty
+		for start, end, cls in self.layout.slots:
+			if data[start:start+len(empty)] != empty: yield start, data[start:end], cls
+
+	def records(self, lazy=None):
+		'''Iterate over the records of non-empty slots on the card'''
+		slots = list(self.slots())
+		if OvcRecord.cache is not None:
+			OvcRecord.cache.prefetch([(cls, sdata) for addr, sdata, cls in slots if addr not in self._records])
+		for addr, sdata, cls in slots:
+			record = self._records.get(addr)
+			if record is None: record = self._records[addr] = cls(sdata, lazy)
+			yield record
+
+	def record(self, addr):
+		'''Return record of the slot at address, None when the slot is empty'''
+		for start, sdata, cls in self.slots():
+			if start != addr: continue
+			record = self._records.get(addr)
+			if record is None: record = self._records[addr] = cls(sdata)
+			return record
+		return None
+
+	def __str__(self):
+		if self.cardid is None: return ''
+		s = 'OV-Chipkaart id %d, %s, valid until %s'%(self.cardid, self.cardtype, self.validuntil)
+		if self.cardtype==2:
+			s += ', birthdate %s'%self.birthdate
+		return s
+
+
+class OvcCardDecoder:
+	'''Decodes successive dumps of cards, reusing the records of slots that
+	didn't change since the previous dump of the same card. Previous dumps
+	are kept by card id (the first four bytes), for at most size cards.'''
+
+	def __init__(self, size=1024):
+		self.size = size
+		self._cards = OrderedDict()
+
+	def decode(self, data, previous=None):
+		'''Return tuple of card and list of addresses of slots that changed.
+		Slots are compared to previous, an OvcCard or dump of the same card,
+		or else to the last dump of this card given to the decoder. Without
+		a previous dump, all non-empty slots have changed.'''
+		card = OvcCard(data)
+		key = card.key()
+		cached = self._cards.pop(key, None)
+		if previous is None: previous = cached
+		elif not isinstance(previous, OvcCard): previous = OvcCard(previous)
+		if previous is None or previous.layout is not card.layout:
+			changed = [x[0] for x in card.slots()]
+		else:
+			changed = []
+			new, old = memoryview(card.data), memoryview(previous.data)
+			for start, end, slots in card.layout.areaslots:
+				# compare slots only in areas that changed
+				areachanged = new[start:end] != old[start:end]
+				for start, end, cls in slots:
+					if areachanged and new[start:end] != old[start:end]:
+						changed.append(start)
+					elif start in previous._records:
+						card._records[start] = previous._records[start]
+		self._cards[key] = card
+		if len(self._cards) > self.size: self._cards.popitem(last=False)
+		return card, changed
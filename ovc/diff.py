@@ -0,0 +1,163 @@
+#
+# OV-chipkaart decoder: differences between dumps
+#
+# Compares successive dumps of a card byte by byte, sector by sector, and
+# reports which parts of the card layout changed: header fields, record
+# slots and other data. Bits that changed are collected over all dumps.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+from binascii import hexlify
+from collections import OrderedDict
+
+from card import LAYOUTS, OvcCard
+from output import RECORDKINDS
+
+'''Sectors of mifare classic 4k cards and pages of mifare ultralight cards,
+as (name, start address, end address), by dump size. Ultralight pages are
+grouped by four, so that each record slot is within one group.'''
+SECTORS = {
+	4096: [('sector %d'%s, s*0x40, (s+1)*0x40) for s in range(32)] +
+	      [('sector %d'%s, 0x800 + (s-32)*0x100, 0x900 + (s-32)*0x100) for s in range(32, 40)],
+	64:   [('pages %d-%d'%(p, p+3), p*4, (p+4)*4) for p in range(0, 16, 4)],
+}
+
+
+class OvcChange(object):
+	'''Changed part of a card: a header field, a record slot or other data
+	of a sector. bits are the bits that changed, as number over the bytes
+	from start to end; before and after are the field values or records,
+	None for other data and empty slots.'''
+
+	__slots__ = ('kind', 'name', 'sector', 'start', 'end', 'bits', 'before', 'after')
+
+	def __init__(self, kind, name, sector, start, end, bits, before=None, after=None):
+		self.kind = kind
+		self.name = name
+		self.sector = sector
+		self.start = start
+		self.end = end
+		self.bits = bits
+		self.before = before
+		self.after = after
+
+	def nbits(self):
+		'''Return number of bits changed'''
+		return bin(self.bits).count('1')
+
+	def __str__(self):
+		name = self.kind == 'header' and 'header ' + self.name or self.name
+		s = '%s %s (0x%03x-0x%03x), %d bit%s changed'%(self.sector, name, self.start, self.end,
+			self.nbits(), self.nbits() != 1 and 's' or '')
+		if self.kind == 'header':
+			s += ': %s -> %s'%(self.before, self.after)
+		elif self.kind == 'slot':
+			for sign, record in [('-', self.before), ('+', self.after)]:
+				if record is None: record = '(empty)'
+				s += '\n  %s %s'%(sign, record)
+		return s
+
+
+def _regions(layout):
+	'''Return list of (sector name, start, end, regions) of a layout, regions
+	being a list of (kind, name, start, end) of the parts of a sector'''
+	result = []
+	for sector, start, end in SECTORS[layout.size]:
+		regions = []
+		covered = set()
+		for name, (bstart, bend, ftype, condition) in sorted(layout.header.iteritems(), key=lambda x: x[1][0]):
+			first, last = bstart/8, (bend+7)/8
+			if first < start or last > end: continue
+			regions.append(('header', name, first, last))
+			covered.update(range(first, last))
+		for area in layout.areaslots:
+			slots = [x for x in area[2] if start <= x[0] < end]
+			for i, (sstart, send, cls) in enumerate(slots):
+				regions.append(('slot', '%s %d'%(RECORDKINDS.get(cls, cls.__name__), i), sstart, send))
+				covered.update(range(sstart, send))
+		# what is left are runs of other data
+		addr = start
+		while addr < end:
+			if addr in covered:
+				addr += 1
+				continue
+			dstart = addr
+			while addr < end and addr not in covered: addr += 1
+			regions.append(('data', 'data', dstart, addr))
+		regions.sort(key=lambda x: x[2])
+		result.append((sector, start, end, regions))
+	return result
+
+'''Regions of each card layout, by dump size'''
+REGIONS = dict([(size, _regions(layout)) for size, layout in LAYOUTS.iteritems()])
+
+
+class OvcDiffer:
+	'''Compares successive dumps of cards. Each dump is compared with the
+	previous dump of the same card (by its first four bytes); these are kept
+	for at most size cards. Bits that changed are collected by dump size in
+	a mask, over all dumps compared.'''
+
+	def __init__(self, size=1024):
+		self.size = size
+		self._cards = OrderedDict()
+		'''changed bits of each sector as number, by dump size'''
+		self.masks = dict([(size, [0L]*len(sectors)) for size, sectors in SECTORS.iteritems()])
+		self.dumps = 0
+		self.changed = 0
+
+	def diff(self, data, previous=None):
+		'''Return tuple of card and list of changes since previous, an OvcCard
+		or dump of the same card, or else since the last dump of this card
+		given. Changes are None when there is nothing to compare with.'''
+		card = OvcCard(data)
+		key = card.key()
+		cached = self._cards.pop(key, None)
+		if previous is None: previous = cached
+		elif not isinstance(previous, OvcCard): previous = OvcCard(previous)
+		self._cards[key] = card
+		if len(self._cards) > self.size: self._cards.popitem(last=False)
+		self.dumps += 1
+		if previous is None or previous.layout is not card.layout: return card, None
+		changes = []
+		new, old = memoryview(card.data), memoryview(previous.data)
+		if new == old: return card, changes
+		mask = self.masks[card.layout.size]
+		for i, (sector, start, end, regions) in enumerate(REGIONS[card.layout.size]):
+			if new[start:end] == old[start:end]: continue
+			# bits changed in the whole sector
+			x = long(hexlify(new[start:end]), 16) ^ long(hexlify(old[start:end]), 16)
+			mask[i] |= x
+			for kind, name, rstart, rend in regions:
+				if new[rstart:rend] == old[rstart:rend]: continue
+				bits = (x >> (end-rend)*8) & ((1L << (rend-rstart)*8) - 1)
+				change = OvcChange(kind, name, sector, rstart, rend, bits)
+				if kind == 'header':
+					change.before, change.after = getattr(previous, name), getattr(card, name)
+				elif kind == 'slot':
+					change.before, change.after = previous.record(rstart), card.record(rstart)
+				changes.append(change)
+		if changes: self.changed += 1
+		return card, changes
+
+	def mask(self, size=4096):
+		'''Return bits that changed in dumps of size as string of size bytes'''
+		return ''.join([('%0*x'%((end-start)*2, m)).decode('hex')
+		                for (sector, start, end), m in zip(SECTORS[size], self.masks[size])])
+
+	def maskbits(self, size=4096):
+		'''Return number of bits that changed in dumps of size'''
+		return sum([bin(m).count('1') for m in self.masks[size]])
@@ -0,0 +1,224 @@
+#
+# OV-chipkaart decoder: journeys
+#
+# Pairs check-in, transfer and check-out transactions into journeys, and
+# does so for a stream of dumps, reporting each journey once even when
+# it is on many dumps of the same card.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import datetime
+from collections import OrderedDict
+
+CHECKIN, CHECKOUT, TRANSFER = 1, 2, 6
+
+'''Time after a check-out in which a transfer continues the journey'''
+TRANSFER_WINDOW = datetime.timedelta(minutes=35)
+
+
+class OvcJourney(object):
+	'''Journey of one or more legs. Each leg is a tuple of its check-in (or
+	transfer) and check-out transaction, either of which can be None when
+	it is not on the card.'''
+
+	__slots__ = ('cardid', 'legs')
+
+	def __init__(self, cardid, legs=None):
+		self.cardid = cardid
+		self.legs = legs or []
+
+	def _first(self, i, name):
+		for leg in self.legs:
+			if leg[i] is not None: return getattr(leg[i], name)
+		return None
+
+	def _last(self, i, name):
+		for leg in reversed(self.legs):
+			if leg[i] is not None: return getattr(leg[i], name)
+		return None
+
+	@property
+	def origin(self):
+		'''station of first check-in'''
+		return self.legs[0][0] and self.legs[0][0].station
+
+	@property
+	def destination(self):
+		'''station of last check-out'''
+		return self.legs[-1][1] and self.legs[-1][1].station
+
+	@property
+	def company(self):
+		'''company of first check-in, or first check-out if none'''
+		company = self._first(0, 'company')
+		if company is None: company = self._first(1, 'company')
+		return company
+
+	@property
+	def start(self):
+		'''date and time of first check-in, or first check-out if none'''
+		return self._first(0, 'date') or self._first(1, 'date')
+
+	@property
+	def end(self):
+		'''date and time of last check-out, or last check-in if none'''
+		return self._last(1, 'date') or self._last(0, 'date')
+
+	@property
+	def duration(self):
+		'''time from first check-in to last check-out, or None'''
+		if not self.complete: return None
+		return self.end - self.start
+
+	@property
+	def fare(self):
+		'''sum of the amounts of check-outs, or None when there are none'''
+		amounts = [getattr(leg[1], 'amount', None) for leg in self.legs if leg[1] is not None]
+		amounts = [x for x in amounts if x is not None]
+		if not amounts: return None
+		return sum(amounts)
+
+	@property
+	def transfers(self):
+		return len(self.legs) - 1
+
+	@property
+	def complete(self):
+		'''whether each leg was checked in and out'''
+		return not [leg for leg in self.legs if leg[0] is None or leg[1] is None]
+
+	def key(self):
+		'''Return tuple identifying the journey on a card: its start and the
+		id of its first transaction'''
+		first = self.legs[0][0] or self.legs[0][1]
+		return (self.start, first.id)
+
+	def __str__(self):
+		origin, destination = self.origin, self.destination
+		if origin is None: origin = '(no check-in)'
+		if destination is None: destination = '(no check-out)'
+		s = '%s %s %s -> %s'%(self.start, self.company, origin, destination)
+		if self.duration is not None: s += ' %5d min'%(self.duration.seconds/60 + self.duration.days*24*60)
+		else: s += '          '
+		if self.fare is not None: s += ' \xe2\x82\xac%6.2f'%self.fare
+		if self.transfers: s += ' (%d transfer%s)'%(self.transfers, self.transfers > 1 and 's' or '')
+		return s
+
+
+def transactions(card):
+	'''Return check-in, check-out and transfer transactions of a card in order
+	of time, each once (journeys are logged more than once on a card)'''
+	seen = set()
+	result = []
+	for record in card.records():
+		transfer = getattr(record, 'transfer', None)
+		if transfer not in (CHECKIN, CHECKOUT, TRANSFER) or record.date is None: continue
+		key = (record.date, transfer, record.station, record.id)
+		if key in seen: continue
+		seen.add(key)
+		result.append(record)
+	result.sort(key=lambda r: (r.date, r.id))
+	return result
+
+def _continues(journey, record):
+	'''Return whether a transfer continues a journey: when it is within the
+	transfer window after its last check-out, or on the same day as its last
+	check-in when that wasn't checked out. Otherwise the check-in that went
+	with the transfer is no longer on the card.'''
+	if journey is None: return False
+	checkin, checkout = journey.legs[-1]
+	if checkout is not None: return record.date - checkout.date <= TRANSFER_WINDOW
+	return record.date.date() == checkin.date.date()
+
+def _checksout(journey, record):
+	'''Return whether a check-out ends the last leg of a journey: when that
+	wasn't checked out and was checked in on the same day. Otherwise the
+	check-out that went with the check-in is no longer on the card.'''
+	if journey is None: return False
+	checkin, checkout = journey.legs[-1]
+	return checkout is None and record.date.date() == checkin.date.date()
+
+def card_journeys(card):
+	'''Return journeys of a card, in order of time'''
+	journeys = []
+	current = None
+	for record in transactions(card):
+		if record.transfer == TRANSFER and _continues(current, record):
+			current.legs.append((record, None))
+		elif record.transfer in (CHECKIN, TRANSFER):
+			current = OvcJourney(card.cardid, [(record, None)])
+			journeys.append(current)
+		elif _checksout(current, record):
+			current.legs[-1] = (current.legs[-1][0], record)
+		else:
+			# check-out without its check-in on the card
+			current = OvcJourney(card.cardid, [(None, record)])
+			journeys.append(current)
+	return journeys
+
+
+class OvcJourneyStream:
+	'''Journeys of a stream of dumps, each journey returned once.
+
+	Dumps of a card are expected in order of time. The last journey of a
+	card can still get transfers or a check-out, so it is held back until a
+	later dump of the card has a later journey, or until the card is
+	dropped. At most size cards are tracked; when more are seen, the one
+	seen least recently is dropped.'''
+
+	def __init__(self, size=4096):
+		self.size = size
+		# by card key: tuple of key of last journey returned, and pending journey
+		self._cards = OrderedDict()
+
+	def feed(self, card):
+		'''Add a dump, return list of journeys that are complete'''
+		key = card.key()
+		last, pending = self._cards.pop(key, (None, None))
+		result = []
+		journeys = card_journeys(card)
+		# pending journey that is no longer on the card is done
+		if pending is not None and pending.key() not in [x.key() for x in journeys]:
+			result.append(pending)
+			last = pending.key()
+			pending = None
+		for journey in journeys[:-1]:
+			if last is None or journey.key() > last:
+				result.append(journey)
+				last = journey.key()
+		if journeys and (last is None or journeys[-1].key() > last):
+			pending = journeys[-1]
+		if pending is not None and last is not None and pending.key() <= last:
+			pending = None
+		self._cards[key] = (last, pending)
+		if len(self._cards) > self.size:
+			last, pending = self._cards.popitem(last=False)[1]
+			if pending is not None: result.append(pending)
+		return result
+
+	def close(self):
+		'''Return pending journeys of all cards'''
+		result = [pending for last, pending in self._cards.itervalues() if pending is not None]
+		self._cards.clear()
+		return result
+
+
+def iter_journeys(cards, size=4096):
+	'''Iterate over journeys of cards, each journey once'''
+	stream = OvcJourneyStream(size)
+	for card in cards:
+		for journey in stream.feed(card): yield journey
+	for journey in stream.close(): yield journey
@@ -0,0 +1,196 @@
+#
+# OV-chipkaart decoder: output
+#
+# Writes decoded records as rows of raw field values in JSON lines, CSV
+# or numpy's npz format, without text formatting or station lookups; and
+# text lines, in large blocks.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import csv
+import json
+import datetime
+from binascii import hexlify
+from cStringIO import StringIO
+
+from util import nonzerolen
+from ovcrecord import *
+
+'''Field types of dates, which are written in ISO format'''
+DATETYPES = (datetime.date, OvcDate, OvcDatetime)
+
+'''Kind of record by record class, for the 'record' column'''
+RECORDKINDS = {
+	OvcClassicTransaction: 'transaction',
+	OvcSaldoTransaction:   'saldo',
+	OvcULTransaction:      'ultralight',
+}
+
+def _columns():
+	'''Return list of all columns and set of date columns, fields of all
+	record classes included'''
+	columns = ['dump', 'cardid', 'cardtype', 'validuntil', 'birthdate', 'record', 'template']
+	dates = set(['validuntil', 'birthdate'])
+	for cls in [OvcClassicTransaction, OvcSaldoTransaction, OvcULTransaction]:
+		for fname, fchar, flen, ftype in cls._fieldchars:
+			if fname not in columns: columns.append(fname)
+			if isinstance(ftype, type) and issubclass(ftype, DATETYPES): dates.add(fname)
+	return columns + ['data'], dates
+
+'''Columns of rows, in order, and columns holding dates'''
+COLUMNS, DATECOLUMNS = _columns()
+
+
+def plain(value):
+	'''Return field value as plain Python value, bypassing text formatting'''
+	if value is None: return None
+	if isinstance(value, DATETYPES): return value.isoformat()
+	if isinstance(value, float): return float(value)
+	if isinstance(value, (int, long)): return int(value)
+	return value
+
+def card_rows(name, card):
+	'''Return list of row dicts of plain values, one for each record on the card'''
+	base = {
+		'dump':       name,
+		'cardid':     card.cardid,
+		'cardtype':   plain(card.cardtype),
+		'validuntil': plain(card.validuntil),
+		'birthdate':  plain(card.birthdate),
+	}
+	rows = []
+	for record in card.records():
+		row = base.copy()
+		row['record'] = RECORDKINDS.get(record.__class__, record.__class__.__name__)
+		row['template'] = record.template
+		if record.parsed:
+			for fname, value in record.fields():
+				row[fname] = plain(value)
+		else:
+			row['data'] = hexlify(record.data[:nonzerolen(record.data)])
+		rows.append(row)
+	return rows
+
+
+class OvcWriter:
+	'''Writes rows to a file, in blocks of at least bufsize bytes'''
+
+	def __init__(self, f, bufsize=1<<20):
+		self.f = f
+		self.bufsize = bufsize
+		self._buf = []
+		self._buflen = 0
+
+	def write(self, rows):
+		'''Write list of row dicts'''
+		for row in rows:
+			s = self._format(row)
+			self._buf.append(s)
+			self._buflen += len(s)
+		if self._buflen >= self.bufsize: self.flush()
+
+	def _format(self, row):
+		raise NotImplementedError()
+
+	def flush(self):
+		self.f.write(''.join(self._buf))
+		self.f.flush()
+		self._buf = []
+		self._buflen = 0
+
+	def close(self):
+		self.flush()
+
+
+class TextWriter(OvcWriter):
+	'''Lines of text, as produced by str() of cards and records'''
+	def write(self, lines):
+		if not lines: return
+		s = '\n'.join(lines) + '\n'
+		self._buf.append(s)
+		self._buflen += len(s)
+		if self._buflen >= self.bufsize: self.flush()
+
+
+class JsonlWriter(OvcWriter):
+	'''JSON object for each row on a line; empty fields are left out'''
+	def _format(self, row):
+		return json.dumps(dict([x for x in row.iteritems() if x[1] is not None]), sort_keys=True) + '\n'
+
+
+class CsvWriter(OvcWriter):
+	'''Comma-separated values with a header line'''
+	def __init__(self, f, bufsize=1<<20):
+		OvcWriter.__init__(self, f, bufsize)
+		self._out = StringIO()
+		self._csv = csv.writer(self._out)
+		self._csv.writerow(COLUMNS)
+
+	def _format(self, row):
+		self._csv.writerow([row.get(x) for x in COLUMNS])
+		s = self._out.getvalue()
+		self._out.seek(0)
+		self._out.truncate()
+		return s
+
+
+class NpzWriter(OvcWriter):
+	'''numpy npz archive with an array for each column, written on close.
+	Unlike the other writers, all rows are kept in memory until then.
+	Missing numbers are -1, missing amounts NaN and missing dates NaT;
+	numbers that don't fit in 64 bits are stored as hex strings.'''
+	def __init__(self, f, bufsize=None):
+		OvcWriter.__init__(self, f)
+		self._columns = dict([(x, []) for x in COLUMNS])
+
+	def write(self, rows):
+		for row in rows:
+			for column, values in self._columns.iteritems():
+				values.append(row.get(column))
+
+	def flush(self):
+		pass
+
+	def close(self):
+		import numpy
+		arrays = {}
+		for column, values in self._columns.iteritems():
+			present = [x for x in values if x is not None]
+			if not present:
+				continue
+			elif column in DATECOLUMNS:
+				arrays[column] = numpy.array([x is None and 'NaT' or x for x in values], 'datetime64')
+			elif isinstance(present[0], float):
+				arrays[column] = numpy.array([x is None and numpy.nan or x for x in values], numpy.float64)
+			elif isinstance(present[0], (int, long)) and max(present) < (1<<63):
+				arrays[column] = numpy.array([x is None and -1 or x for x in values], numpy.int64)
+			elif isinstance(present[0], (int, long)):
+				arrays[column] = numpy.array([x is not None and '%x'%x or '' for x in values])
+			else:
+				arrays[column] = numpy.array([x is None and '' or x for x in values])
+		# zip archives are written with seeks, which pipes can't do
+		buf = StringIO()
+		numpy.savez_compressed(buf, **arrays)
+		self.f.write(buf.getvalue())
+		self.f.flush()
+
+
+'''Writers by output format name'''
+WRITERS = {
+	'jsonl': JsonlWriter,
+	'csv':   CsvWriter,
+	'npz':   NpzWriter,
+}
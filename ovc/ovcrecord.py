@@ -17,48 +17,37 @@
 #
 
 import re
-from util import getbits
+from binascii import hexlify
+from util import getbits, nonzerolen
+import stats
 from ovctypes import *
 
 
-class OvcRecord:
-	'''Match binary records with templates. Needs to be subclassed.'''
+'''Value of a field of a lazy record that is not decoded yet'''
+_LAZY = object()
 
-	'''Description of record fields. Each record is matched to each of the
-	fields. Hex digits ([0-9a-f]) must match literally, while uppercase
-	characters ([G-Z?]) are fields.
-	Each item is a tuple of the template string and an optional dict of
-	bit-offsets in the nibble. See child classes for examples.'''
-	_templates = []
-	'''Field descriptions, to bind characters in _templates to fields.
-	list of: (fieldname, char, bitlength, type_or_conversion_function)'''
-	_fieldchars = []
 
-	def __init__(self, data):
-		self.parsed = False
-		self.data = data
-		# create empty fields
-		for fieldinfo in self._fieldchars:
-			fname, fchar, flen, ftype = fieldinfo
-			self.__dict__[fname] = None
-		# parse template
-		for t in self._templates:
-			if self._parsetemplate(t):
-				self.parsed = True
-				break
+class OvcTemplate:
+	'''Decode plan of a single template, compiled once per record class.
 
-	def _parsetemplate(self, template):
+	Field boundaries are resolved here, so that matching a record only
+	needs comparing literals and extracting bits of fields.'''
+
+	def __init__(self, template, fieldchars, index=None):
 		if isinstance(template, str): template = [template]
+		self.template = template
+		self.index = index
+		self._fieldinfo = {}
+		for fieldinfo in fieldchars:
+			self._fieldinfo.setdefault(fieldinfo[1], []).append(fieldinfo)
 		# remove spaces from template
 		tmplstr = re.sub('\s+', '', template[0])
-		# if template is shorter than data, don't match
-		data = self.data.rstrip('\0')
-		if len(data) > len(tmplstr)/2: return False
-		# pad data with zeroes to match with template
-		data = self.data + '\0'*max(0, len(tmplstr)/2-len(self.data))
+		# records with more (non-zero) data than the template don't match
+		self.length = len(tmplstr)/2
 		# create template data with variables set to zero to be able to use getdata()
 		tmpldatastr = re.sub('[^0-9a-f]', '0', tmplstr)
-		tmpldata = ''.join([chr(int(tmpldatastr[i:i+2], 16)) for i in range(0, len(tmpldatastr), 2)])
+		tmpldatastr += '0'*(len(tmpldatastr)%2)
+		tmpldata = tmpldatastr.decode('hex')
 
 		# determine fields and their nibble-offsets from template
 		fields = []		# field names (or '0' for literal)
@@ -96,28 +85,61 @@ class OvcRecord:
 			offsets[i] = tmploffsets[i]
 			self._apply_fixedwidth(fields, offsets)
 
-		# now parse all fields
-		fieldvalues={}
+		# bind literals and fields to their bit ranges
+		literals = []
+		boundfields = []
 		for i in range(len(fields)):
-			value = getbits(data, offsets[i], offsets[i+1])
-			curchar = fields[i]
-			if curchar == '0':
-				# literal: check with template
-				tmplvalue = getbits(tmpldata, offsets[i], offsets[i+1])
-				if tmplvalue != value: return False
+			start, end = offsets[i], offsets[i+1]
+			width = (end-start+3)/4
+			# getbits() includes the bits before start when a range lies
+			# within a single byte and doesn't end on a byte boundary; the
+			# bit ranges here must give the very same values
+			if start/8 == (end-1)/8 and start%8 and end%8:
+				start = start - start%8 + max(0, start%8 + end%8 - 8)
+			if fields[i] == '0':
+				literals.append((start, end, getbits(tmpldata, start, end)))
 			else:
-				# template variable: store
-				fname, fchar, flen, ftype = self._field_by_char(curchar)
-				try: fieldvalues[fname] = ftype(value, obj=self, width=(offsets[i+1]-offsets[i]+3)/4)
-				except TypeError: fieldvalues[fname] = ftype(value)
+				fname, fchar, flen, ftype = self._field_by_char(fields[i])
+				boundfields.append((fname, start, end, ftype, width))
+		self.literals = tuple(literals)
+		self.fields = tuple(boundfields)
+		# data is padded to this size, so that all bit ranges can be read
+		self.size = max([self.length] + [(end+7)/8 for start,end,value in literals] +
+		                [(f[2]+7)/8 for f in boundfields])
+		del self._fieldinfo
+
+		# all literals combined, to match a record with a single comparison
+		self.mask = 0L
+		self.value = 0L
+		for start, end, value in literals:
+			shift = self.size*8 - end
+			self.mask |= ((1L<<(end-start))-1) << shift
+			self.value |= value << shift
+		# position in fieldchars, shift and mask to extract each field from
+		# the record as a number
+		positions = dict([(fieldinfo[0], pos) for pos, fieldinfo in enumerate(fieldchars)])
+		self.extract = tuple([(positions[fname], self.size*8-end, (1L<<(end-start))-1, ftype, width)
+		                      for fname, start, end, ftype, width in boundfields])
+		# extraction of each field by position, None for fields not in template
+		fieldpos = [None] * len(fieldchars)
+		for x in self.extract: fieldpos[x[0]] = x[1:]
+		self.fieldpos = tuple(fieldpos)
+		# values of a lazy record before fields are decoded
+		self.lazyvalues = tuple([x and _LAZY for x in fieldpos])
+		# shift and mask of the company field, passed to field types
+		self.company = None
+		if 'company' in positions and fieldpos[positions['company']]:
+			self.company = fieldpos[positions['company']][:2]
 
-		# everything is ok, incorporate fields
-		self.__dict__.update(fieldvalues)
-		return True
+	def prefixlen(self):
+		'''Return number of leading bytes that are fully literal'''
+		n = 0
+		while n < self.size and (self.mask >> (self.size-n-1)*8) & 0xff == 0xff: n += 1
+		return n
 
 	def _field_by_char(self, fchar):
 		'''Return fieldinfo record by character'''
-		fieldinfo = filter(lambda x: x[1]==fchar, self._fieldchars)
+		fieldinfo = self._fieldinfo.get(fchar)
 		if not fieldinfo:
 			raise KeyError("Template character '%c' not found in fieldchars"%fchar)
 		elif len(fieldinfo) > 1:
@@ -141,24 +163,221 @@ class OvcRecord:
 			changed = True
 		return changed
 
+
+class OvcTemplateIndex:
+	'''Dispatch index over the compiled templates of a record class.
+
+	Templates are grouped by their leading literal bytes (type byte, flags
+	and marker for transactions), so that a record is only matched against
+	templates that can possibly match it.'''
+
+	def __init__(self, templates, fieldchars):
+		self.plans = tuple([OvcTemplate(t, fieldchars, i) for i,t in enumerate(templates)])
+		# records are converted to a number of this many bytes
+		self.width = max([0] + [plan.size for plan in self.plans])
+		self.prefixlen = min([plan.prefixlen() for plan in self.plans] or [0])
+		self.fieldnames = frozenset([x[0] for x in fieldchars])
+		# position of each field in the list of values of a record
+		self.positions = dict([(x[0], pos) for pos, x in enumerate(fieldchars)])
+		# plans by their literal prefix as a number
+		self._index = {}
+		for plan in self.plans:
+			prefix = plan.value >> (plan.size-self.prefixlen)*8
+			self._index.setdefault(prefix, []).append(plan)
+		for prefix in self._index:
+			self._index[prefix] = tuple(self._index[prefix])
+
+	def candidates(self, value, length):
+		'''Return templates that may match data of length bytes, as number value'''
+		if length >= self.prefixlen: prefix = value >> (length-self.prefixlen)*8
+		else: prefix = value << (self.prefixlen-length)*8
+		return self._index.get(prefix, ())
+
+	def tonumber(self, data):
+		'''Return data (any buffer) as number'''
+		return long(hexlify(data) or '0', 16)
+
+
+class _OvcField(object):
+	'''Record field, stored in the record's list of values by position.
+	Fields of lazy records are decoded when first accessed.'''
+	__slots__ = ('pos',)
+
+	def __init__(self, pos):
+		self.pos = pos
+
+	def __get__(self, obj, cls):
+		if obj is None: return self
+		value = obj._values[self.pos]
+		if value is _LAZY: value = obj._values[self.pos] = obj._decode(self.pos)
+		return value
+
+	def __set__(self, obj, value):
+		obj._values[self.pos] = value
+
+
+class OvcRecord(object):
+	'''Match binary records with templates. Needs to be subclassed.
+
+	Field values are kept in a list, in the order of _fieldchars, and are
+	accessed as attributes. Field types get the record's company, when it
+	has one, instead of the record itself, so that no reference cycles
+	are created.'''
+
+	__slots__ = ('data', 'parsed', 'template', '_values', '_plan', '_bits')
+
+	'''Description of record fields. Each record is matched to each of the
+	fields. Hex digits ([0-9a-f]) must match literally, while uppercase
+	characters ([G-Z?]) are fields.
+	Each item is a tuple of the template string and an optional dict of
+	bit-offsets in the nibble. See child classes for examples.'''
+	_templates = []
+	'''Field descriptions, to bind characters in _templates to fields.
+	list of: (fieldname, char, bitlength, type_or_conversion_function)'''
+	_fieldchars = []
+	'''Decode fields only when they are first accessed, by default'''
+	lazy = False
+	'''Cache of matched templates (see ovc.cache), or None'''
+	cache = None
+
+	def __init__(self, data, lazy=None):
+		index = self._compile()
+		self.parsed = False
+		self.data = data
+		# index of matched template
+		self.template = None
+		# matched template and record as number, for decoding lazy fields
+		self._plan = None
+		self._bits = None
+		if lazy is None: lazy = self.lazy
+		# parse template
+		st = stats.current
+		if st is not None: t = stats.timer()
+		if self.cache is not None: match = self.cache.match(self.__class__, data)
+		else: match = self._first(data)
+		if st is not None:
+			st.times['match'] += stats.timer() - t
+			st.record(self.__class__, data, match and match[0].index)
+		if match is None:
+			self._values = [None] * len(index.fieldnames)
+			return
+		plan, bits = match
+		if lazy:
+			self._plan, self._bits = plan, bits
+			self._values = list(plan.lazyvalues)
+		else:
+			self._values = self._parseplan(plan, bits)
+		self.parsed = True
+		self.template = plan.index
+
+	@classmethod
+	def _compile(cls):
+		'''Return template index of this class, compiling templates on first use'''
+		compiled = cls.__dict__.get('_compiled')
+		if compiled is None or compiled[0] is not cls._templates:
+			index = OvcTemplateIndex(cls._templates, cls._fieldchars)
+			for pos, fieldinfo in enumerate(cls._fieldchars):
+				if fieldinfo[0] in OvcRecord.__dict__:
+					raise KeyError("Field name '%s' is reserved"%fieldinfo[0])
+				setattr(cls, fieldinfo[0], _OvcField(pos))
+			compiled = cls._compiled = (cls._templates, index)
+		return compiled[1]
+
+	@classmethod
+	def _match(cls, data):
+		'''Iterate over (plan, record number) of templates matching data'''
+		index = cls._compile()
+		length = len(data)
+		value = index.tonumber(data)
+		st = stats.current
+		for plan in index.candidates(value, length):
+			if st is not None: st.template(cls, plan.index)[0] += 1
+			# if template is shorter than data, don't match
+			if length > plan.length and value & ((1L<<(length-plan.length)*8)-1): continue
+			# record number of the template's size, padded with zeroes
+			if length >= plan.size: bits = value >> (length-plan.size)*8
+			else: bits = value << (plan.size-length)*8
+			if bits & plan.mask == plan.value:
+				if st is not None: st.template(cls, plan.index)[1] += 1
+				yield plan, bits
+
+	@classmethod
+	def _first(cls, data):
+		'''Return (plan, record number) of the first template matching data, or None'''
+		for match in cls._match(data): return match
+		return None
+
+	@classmethod
+	def matching_templates(cls, data):
+		'''Return indices of all templates matching data.
+		More than one means the templates are ambiguous for this record;
+		the record is then parsed with the first one.'''
+		return [plan.index for plan, bits in cls._match(data)]
+
+	def _parseplan(self, plan, bits):
+		'''Return list of field values of record number bits'''
+		st = stats.current
+		if st is not None: t = stats.timer()
+		company = plan.company and (bits >> plan.company[0]) & plan.company[1]
+		values = [None] * len(plan.fieldpos)
+		for pos, shift, mask, ftype, width in plan.extract:
+			values[pos] = self._field(ftype, (bits >> shift) & mask, width, company)
+		if st is not None: st.times['typing'] += stats.timer() - t
+		return values
+
+	def _decode(self, pos):
+		'''Return value of field at position, decoded from the matched template'''
+		plan, bits = self._plan, self._bits
+		shift, mask, ftype, width = plan.fieldpos[pos]
+		company = plan.company and (bits >> plan.company[0]) & plan.company[1]
+		st = stats.current
+		if st is None: return self._field(ftype, (bits >> shift) & mask, width, company)
+		t = stats.timer()
+		value = self._field(ftype, (bits >> shift) & mask, width, company)
+		st.times['typing'] += stats.timer() - t
+		return value
+
+	def _field(self, ftype, value, width, company=None):
+		'''Return field value converted to its type'''
+		try: return ftype(value, company=company, width=width)
+		except TypeError: return ftype(value)
+
 	def getbits(self, start, end):
 		# return number at bit positions of data (0 is beginning)
 		return getbits(self.data, start, end)
 
+	def fields(self):
+		'''Return list of (fieldname, value) of the fields present in the record'''
+		values = [(x[0], getattr(self, x[0])) for x in self._fieldchars]
+		return [x for x in values if x[1] is not None]
+
+	def _strfields(self):
+		'''Return dict of field values to print instead of the record's own'''
+		return {}
+
 	def __str__(self):
+		st = stats.current
+		if st is not None: t = stats.timer()
 		s = ''
 		if self.parsed:
-			fields = filter(lambda x: self.__dict__[x] is not None, [x[0] for x in self._fieldchars])
-			s += ' '.join([str(self.__dict__[x]) for x in fields])
+			values = self._values
+			if self._plan is not None: values = [getattr(self, x[0]) for x in self._fieldchars]
+			override = self._strfields()
+			if override:
+				values = list(values)
+				positions = self._compile().positions
+				for fname, value in override.iteritems(): values[positions[fname]] = value
+			s += ' '.join([str(x) for x in values if x is not None])
 		else:
-			data = self.data
-			while data and data[-1]=='\0': data = data[:-1]
-			s += ' '.join(['%02x'%ord(x) for x in data])
+			data = hexlify(self.data[:nonzerolen(self.data)])
+			s += ' '.join([data[i:i+2] for i in range(0, len(data), 2)])
+		if st is not None: st.times['render'] += stats.timer() - t
 		return s
 
 
 class OvcClassicTransaction(OvcRecord):
 	'''Transaction on a mifare classic card'''
+	__slots__ = ()
 
 	_fieldchars = [
 			('id',        'I',   12, OvcTransactionId),
@@ -213,23 +432,26 @@ class OvcClassicTransaction(OvcRecord):
 	        ( '0a 02 e0 0? MB BB B0 00 00 II IU UU 3e RR R0 00 OO OW WW WW WW WW WW WW WW WW WW WW WW WW WW W', {'R': -1} ),
 	] 
 
-	def __init__(self, data):
-		OvcRecord.__init__(self, data)
+	def _strfields(self):
 		# TODO move this pretty-print stuff to some better place
-		if self.id is None: self.id = '    '
-		if self.transfer is None and self.data[0]!='\x0a': self.transfer = '         '
-		if self.amount is None and self.data[0] not in ['\x0a', '\x20']: self.amount = '       '
-		if self.data[0]=='\x08': self.transfer = 'credit   '
-		if self.data[0]=='\x20': self.transfer = 'add product      '
+		override = {}
+		first = self.data[0]
+		if self.id is None: override['id'] = '    '
+		if self.transfer is None and first!='\x0a': override['transfer'] = '         '
+		if self.amount is None and first not in ['\x0a', '\x20']: override['amount'] = '       '
+		if first=='\x08': override['transfer'] = 'credit   '
+		if first=='\x20': override['transfer'] = 'add product      '
+		return override
 
 	def __str__(self):
-		s = '[%02x_%02x_%02x_%x] '%(ord(self.data[0]),ord(self.data[1]),ord(self.data[2]),ord(self.data[3])>>4)
-		return s + OvcRecord.__str__(self)
+		h = hexlify(self.data[:4])
+		return '[%s_%s_%s_%s] '%(h[0:2], h[2:4], h[4:6], h[6]) + OvcRecord.__str__(self)
 
 
 # TODO this is very very prelim
 class OvcULTransaction(OvcRecord):
 	'''Transaction on a mifare ultralight card (only GVB tested)'''
+	__slots__ = ()
 	_fieldchars = [
 		('id',        'I',   15, OvcTransactionId),
 		('date',      'T',   25, OvcDatetime),
@@ -245,3 +467,20 @@ class OvcULTransaction(OvcRecord):
                 ('?I II UU UM YT TT TT TV VV VV VV VV VV VV VV VV', {'I':1, 'T':-1}),
 	]
 
+
+class OvcSaldoTransaction(OvcRecord):
+	'''Saldo (balance) record on a mifare classic card'''
+	__slots__ = ()
+	_fieldchars = [
+		('id',     'I',   12, OvcTransactionId),
+		('idsaldo','H',   12, OvcSaldoTransactionId),
+		('saldo',  'N',   16, OvcAmountSigned),
+		('unkU',   'U', None, FixedWidthHex),
+		('unkV',   'V', None, FixedWidthHex),
+	]
+	_templates = [
+		('20 II I0 00 00 00 80 HH H0 0N NN N0', {'I':1, 'N':1}),
+	]
+	def __str__(self):
+		s = '[saldo_%02x__] '%(ord(self.data[0]))
+		return s + OvcRecord.__str__(self)
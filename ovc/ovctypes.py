@@ -17,13 +17,18 @@
 #
 
 import datetime
+import operator
 import stations
 from util import bcd2int
 
 
+_widths = {}
 def _rfill(s, l):
-	'''Fill string right with spaces to make as long as longest value in list/dict'''
-	return s + ' '*(_maxlength(l)-len(s))
+	'''Fill string right with spaces to make as long as longest value in list/dict.
+	The length is computed once for each list/dict, which are constant.'''
+	width = _widths.get(id(l))
+	if width is None: width = _widths[id(l)] = _maxlength(l)
+	return s + ' '*(width-len(s))
 
 def _maxlength(l):
 	'''Return maximum length of strings in (nested) list or dict'''
@@ -31,27 +36,146 @@ def _maxlength(l):
 	if isinstance(l, list): return max([_maxlength(x) for x in l])
 	return len(l)
 
+_subclasses = {}
+def _subclass(cls, name, value):
+	'''Return subclass of cls with class attribute name set to value.
+	Values of the subclass get their context (company, field width) from
+	their class, instead of storing it or a reference to their record.'''
+	if getattr(cls, name) == value: return cls
+	key = (cls, name, value)
+	sub = _subclasses.get(key)
+	if sub is None:
+		sub = _subclasses[key] = type(cls.__name__, (cls,),
+			{'__slots__': (), '__module__': cls.__module__, name: value})
+	return sub
 
-class OvcDate(datetime.date):
-	'''date with ovc-integer constructor'''
-	# TODO subclassing this built-in type doesn't work fully :(
+
+_epoch = datetime.date(1997, 1, 1)
+_isodates = {}
+def _isodate(days):
+	'''Return date of days since 1997 in ISO format, cached by day'''
+	s = _isodates.get(days)
+	if s is None:
+		s = _isodates[days] = datetime.date.fromordinal(_epoch.toordinal() + days).isoformat()
+	return s
+
+def _compare(op):
+	'''Return comparison of a date number with dates and date numbers as date.
+	Like dates, it is never equal to a plain number and can't be ordered
+	with one; int(x) compares by number.'''
+	def compare(self, other):
+		if type(other) is type(self): return op(int(self), int(other))
+		if isinstance(other, _OvcDateNumber): return op(self._value(), other._value())
+		if isinstance(other, datetime.date): return op(self._value(), other)
+		if op is operator.eq: return False
+		if op is operator.ne: return True
+		raise TypeError('can\'t compare %s to %s'%(type(self).__name__, type(other).__name__))
+	return compare
+
+class _OvcDateNumber(int):
+	'''date stored as number, which compares, hashes, adds and subtracts like
+	the datetime.date or datetime.datetime returned by _value() when the other
+	operand is a date, timedelta or date number, and adds and subtracts like
+	a number else. Like a date it is always true, also on the epoch.'''
+	__slots__ = ()
+	epoch = _epoch
+	__eq__ = _compare(operator.eq)
+	__ne__ = _compare(operator.ne)
+	__lt__ = _compare(operator.lt)
+	__le__ = _compare(operator.le)
+	__gt__ = _compare(operator.gt)
+	__ge__ = _compare(operator.ge)
+	def __hash__(self):
+		# equal dates and date numbers hash alike, so they find each other in dicts
+		return hash(self._value())
+	def __nonzero__(self):
+		return True
+	def __add__(self, other):
+		if isinstance(other, datetime.timedelta): return self._value() + other
+		return int.__add__(self, other)
+	__radd__ = __add__
+	def __sub__(self, other):
+		if isinstance(other, _OvcDateNumber): return self._value() - other._value()
+		if isinstance(other, (datetime.date, datetime.timedelta)): return self._value() - other
+		return int.__sub__(self, other)
+	def __rsub__(self, other):
+		if isinstance(other, datetime.date): return other - self._value()
+		return int.__rsub__(self, other)
+	@property
+	def year(self):
+		return self.date().year
+	@property
+	def month(self):
+		return self.date().month
+	@property
+	def day(self):
+		return self.date().day
+	def weekday(self):
+		return self.date().weekday()
+	def isoweekday(self):
+		return self.date().isoweekday()
+	def timetuple(self):
+		return self._value().timetuple()
+	def strftime(self, fmt):
+		return self._value().strftime(fmt)
+
+class OvcDate(_OvcDateNumber):
+	'''date as number of days since 1997; like datetime.date when compared
+	with, added to, subtracted from or formatted, converted to one by date()'''
+	__slots__ = ()
 	def __new__(cls, x, **kwargs):
-		d = datetime.date.__new__(cls, 1997, 1, 1)
-		d += datetime.timedelta(x)
-		return d
+		return int.__new__(cls, x)
+	def date(self):
+		return datetime.date.fromordinal(_epoch.toordinal() + self)
+	_value = date
+	def isoformat(self):
+		return _isodate(int(self))
+	def __sub__(self, other):
+		if type(other) is OvcDate: return datetime.timedelta(int(self) - int(other))
+		return _OvcDateNumber.__sub__(self, other)
 	def __str__(self):
-		return self.strftime('%d-%m-%Y')
+		return _isodate(int(self))
 
 
-class OvcDatetime(datetime.datetime):
-	'''datetime with ovc-integer constructor'''
-	# TODO subclassing this built-in type doesn't work fully :(
+class OvcDatetime(_OvcDateNumber):
+	'''date and time as number of days since 1997 shifted left 11 bits, or'd
+	with minutes since midnight; like datetime.datetime when compared with,
+	added to, subtracted from or formatted, converted to one by datetime().
+	Minutes of 24:00 and later are moved to the next days, so that the number
+	is the same as that of the datetime.'''
+	__slots__ = ()
 	def __new__(cls, x, **kwargs):
-		d = datetime.datetime.__new__(cls, 1997, 1, 1)
-		d += datetime.timedelta(x>>11, (x&((1<<11)-1))*60)
-		return d
+		if x&0x7ff >= 24*60: x = ((x>>11) + (x&0x7ff)/(24*60))<<11 | (x&0x7ff)%(24*60)
+		return int.__new__(cls, x)
+	@property
+	def days(self):
+		'''days since 1997'''
+		return int(self>>11)
+	@property
+	def minutes(self):
+		'''minutes since midnight'''
+		return int(self&0x7ff)
+	@property
+	def hour(self):
+		return self.minutes/60
+	@property
+	def minute(self):
+		return self.minutes%60
+	def date(self):
+		return datetime.date.fromordinal(_epoch.toordinal() + self.days)
+	def time(self):
+		return datetime.time(self.minutes/60, self.minutes%60)
+	def datetime(self):
+		return datetime.datetime.combine(self.date(), self.time())
+	_value = datetime
+	def isoformat(self, sep='T'):
+		return '%s%s%02d:%02d:00'%(_isodate(self.days), sep, self.minutes/60, self.minutes%60)
+	def __sub__(self, other):
+		if type(other) is OvcDatetime:
+			return datetime.timedelta(self.days - other.days, (self.minutes - other.minutes)*60)
+		return _OvcDateNumber.__sub__(self, other)
 	def __str__(self):
-		return self.strftime('%d-%m-%Y %H:%m')
+		return self.isoformat(' ')
 
 class OvcBcdDate(datetime.date):
 	'''date with ovc-BCD constructor'''
@@ -63,6 +187,7 @@ class OvcBcdDate(datetime.date):
 		return datetime.date.__new__(cls, year, month, day)
 
 class OvcCardType(int):
+	__slots__ = ()
 	_strs = { 0: 'anonymous', 2: 'personal'}
 	def __new__(cls, x, **kwargs):
 		return int.__new__(cls, x)
@@ -71,6 +196,7 @@ class OvcCardType(int):
 		except KeyError: return 'cardtype %d'%self
 
 class OvcTransfer(int):
+	__slots__ = ()
 	_strs = { 0: 'purchase', 1: 'check-in', 2: 'check-out', 6: 'transfer' }
 	def __new__(cls, x, **kwargs):
 		return int.__new__(cls, x)
@@ -79,6 +205,7 @@ class OvcTransfer(int):
 		except KeyError: return _rfill('trnsfr %d'%self, self._strs)
 
 class OvcCompany(int):
+	__slots__ = ()
 	# most companies can be figured out using
 	# https://www.ov-chipkaart.nl/webwinkel/aanvragen/aanvragen_pkaart/kaartaanvragen/?ovbedrijf=<number>
 	# pending: Breng (Novio), GVU, Hermes, Qbuzz
@@ -112,39 +239,46 @@ class OvcSubscription(int):
 			0x09ca: 'studwkkort', #could also be studwkvrij
 		}
 	}
-	def __new__(cls, x, obj, **kwargs):
-		i = int.__new__(cls, x)
-		i._obj = obj
-		return i
+	__slots__ = ()
+	company = None
+	def __new__(cls, x, company=None, **kwargs):
+		return int.__new__(_subclass(cls, 'company', company), x)
+	def __reduce__(self):
+		return (OvcSubscription, (int(self), self.company))
 	def __str__(self):
-		try: return _rfill(self._strs[self._obj.company][self], self._strs)
+		try: return _rfill(self._strs[self.company][self], self._strs)
 		except KeyError: return _rfill('subscription %d'%self, self._strs)
 
 _ostwidth = 0
 class OvcStation(int):
-	def __new__(cls, x, obj, **kwargs):
-		i = int.__new__(cls, x)
-		i._obj = obj
-		return i
+	'''station number; its company is a class attribute'''
+	__slots__ = ()
+	company = None
+	def __new__(cls, x, company=None, **kwargs):
+		return int.__new__(_subclass(cls, 'company', company), x)
+	def __reduce__(self):
+		return (OvcStation, (int(self), self.company))
 	def __str__(self):
 		# compute maximum length of station name and cache it
 		global _ostwidth
 		if not _ostwidth: _ostwidth = stations.get_max_len('title')
 		# get station name and pad string
-		s = stations.get(self._obj.company, self)
-		if not s or not s.title:
-			s = '(station %5d)'%self
-		else:
-			s = s.title
-		return s + ' '*(_ostwidth-len(s))
+		s = stations.title(self.company, self)
+		if not s: s = '(station %5d)'%self
+		# pad by characters, output is utf-8 like the euro sign of amounts
+		s += ' '*(_ostwidth-len(s))
+		if isinstance(s, unicode): s = s.encode('utf-8')
+		return s
 
 class OvcTransactionId(int):
+	__slots__ = ()
 	def __new__(cls, x,  **kwargs):
 		return int.__new__(cls, x)
 	def __str__(self):
 		return '#%03d'%self
 
 class OvcSaldoTransactionId(int):
+	__slots__ = ()
 	def __new__(cls, x,  **kwargs):
 		return int.__new__(cls, x)
 	def __str__(self):
@@ -152,6 +286,7 @@ class OvcSaldoTransactionId(int):
 
 class OvcAmount(float):
 	'''amount in euro; prints '-' when zero'''
+	__slots__ = ()
 	def __new__(cls, x, **kwargs):
 		return float.__new__(cls, x/100.0)
 	def __str__(self):
@@ -160,6 +295,7 @@ class OvcAmount(float):
 
 class OvcAmountSigned(float):
 	'''amount in euro; 16 bit signed number'''
+	__slots__ = ()
 	def __new__(cls, x, **kwargs):
  		x = x - (1<<15)
 		return float.__new__(cls, x/100.0)
@@ -167,18 +303,22 @@ class OvcAmountSigned(float):
 		return '\xe2\x82\xac%6.2f'%self
 
 class FixedWidthDec(long):
+	__slots__ = ()
+	_fieldwidth = 0
 	def __new__(cls, x, width=0, **kwargs):
-		i = long.__new__(cls, x)
-		i._fieldwidth = width
-		return i
+		return long.__new__(_subclass(cls, '_fieldwidth', width), x)
+	def __reduce__(self):
+		return (FixedWidthDec, (long(self), self._fieldwidth))
 	def __str__(self):
 		return ('%d'%long(self)).zfill(self._fieldwidth)
 
 class FixedWidthHex(long):
+	__slots__ = ()
+	_fieldwidth = 0
 	def __new__(cls, x, width=0, **kwargs):
-		i = long.__new__(cls, x)
-		i._fieldwidth = width
-		return i
+		return long.__new__(_subclass(cls, '_fieldwidth', width), x)
+	def __reduce__(self):
+		return (FixedWidthHex, (long(self), self._fieldwidth))
 	def __str__(self):
 		return '0x'+('%x'%self).zfill(self._fieldwidth)
 
@@ -18,7 +18,12 @@
 
 import os
 import sys
+import mmap
+import struct
 import sqlite3
+from collections import OrderedDict
+
+import stats
 
 
 class OvcStation:
@@ -35,44 +40,269 @@ class OvcStation:
 		return self.title
 
 
+class StationIndex:
+	'''compact station index, memory-mapped read-only so that its pages are
+	shared between processes. See write_index() in stations/createdb.py
+	for the file format.'''
+
+	_header = struct.Struct('<8s3I')
+	_key = struct.Struct('<Q')
+	_offset = struct.Struct('<2I')
+	_float = struct.Struct('<d')
+
+	def __init__(self, filename):
+		f = open(filename, 'rb')
+		try: self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally: f.close()
+		magic, n, m, bloblen = self._header.unpack_from(self._mm, 0)
+		if magic != 'OVCSTIX1':
+			raise ValueError('Not a station index: %s'%filename)
+		self.n = n
+		self._keys = self._header.size
+		self._offsets = self._keys + 8*n
+		self._lons = self._offsets + 4*(n+1)
+		self._lats = self._lons + 8*n
+		widths = struct.unpack_from('<%dI'%(2*m), self._mm, self._lats + 8*n)
+		self._blob = self._lats + 8*n + 8*m
+		'''maximum title length by company'''
+		self.widths = dict(zip(widths[0::2], widths[1::2]))
+
+	def find(self, company, ovcid):
+		'''return position of station in index, or None'''
+		key = company<<32 | ovcid
+		lo, hi = 0, self.n
+		unpack, mm, keys = self._key.unpack_from, self._mm, self._keys
+		while lo < hi:
+			mid = (lo+hi)//2
+			if unpack(mm, keys + 8*mid)[0] < key: lo = mid+1
+			else: hi = mid
+		if lo < self.n and unpack(mm, keys + 8*lo)[0] == key: return lo
+		return None
+
+	def keys(self):
+		'''return list of (company, ovcid) of all stations'''
+		keys = struct.unpack_from('<%dQ'%self.n, self._mm, self._keys)
+		return [(k>>32, k&0xffffffff) for k in keys]
+
+	def _title(self, i):
+		start, end = self._offset.unpack_from(self._mm, self._offsets + 4*i)
+		return self._mm[self._blob+start:self._blob+end].decode('utf-8') or None
+
+	def title(self, company, ovcid):
+		'''return station title by number, or None'''
+		i = self.find(company, ovcid)
+		if i is None: return None
+		return self._title(i)
+
+	def get(self, company, ovcid):
+		'''return station by number with only its title and location, or None'''
+		i = self.find(company, ovcid)
+		if i is None: return None
+		d = {'company': company, 'ovcid': ovcid}
+		d['title'] = self._title(i)
+		for name, offset in [('lon', self._lons), ('lat', self._lats)]:
+			x = self._float.unpack_from(self._mm, offset + 8*i)[0]
+			if x != x: x = None	# NaN
+			d[name] = x
+		return OvcStation(d)
+
+
 db = None
 con = None
-def init(_db=None):
-	global db, con
+# compact station index of titles, used instead of the database for these
+idx = None
+_warned = False
+# cached stations by (company, ovcid), None for stations not in database
+_cache = {}
+# cached titles by (company, ovcid) read from the index
+_titles = {}
+# companies of which all stations are in the cache, None when all are
+_loaded = set()
+_preload = 'company'
+_cachesize = None
+# cached maximum lengths by (field, company)
+_maxlen = {}
+# column names of rows in the cache
+_names = None
+
+def init(_db=None, preload='company', cachesize=None):
+	'''open station database.
+	Stations are cached: preload is 'all' to load all stations on first
+	use, 'company' to load all stations of a company on first use of that
+	company, or None to only cache stations looked up. With cachesize, at
+	most that many stations are cached, evicting the least recently used.'''
+	global db, con, idx, _warned, _cache, _titles, _loaded, _preload, _cachesize, _maxlen
 	db = _db
+	_preload = preload
+	_cachesize = cachesize
+	_cache = {}
+	_titles = {}
+	if cachesize: _cache, _titles = _LruDict(cachesize), _LruDict(cachesize)
+	_loaded = set()
+	_maxlen = {}
 	if not db: db = os.path.join(os.path.dirname(__file__), '..', 'stations', 'stations.sqlite')
-	if not os.path.exists(db):
+	if os.path.exists(db):
+		# for convenience also warn if any file in stations is newer than database file
+		dbtime = os.path.getmtime(db)
+		for filename in os.listdir(os.path.dirname(db)):
+			if not filename.endswith('.tsv') or filename.endswith('.sql'): continue
+			ftime = os.path.getmtime(os.path.join(os.path.dirname(db), filename))
+			if ftime > dbtime and not _warned:
+				sys.stderr.write('WARNING: Station database older than its source files, ')
+				sys.stderr.write('you may want to rerun stations/createdb.py\n')
+				_warned = True
+	# titles are read from the compact index when it is up-to-date with the database
+	idx = None
+	idxfile = os.path.splitext(db)[0] + '.idx'
+	if os.path.exists(idxfile) and (not os.path.exists(db) or os.path.getmtime(idxfile) >= os.path.getmtime(db)):
+		try: idx = StationIndex(idxfile)
+		except (IOError, ValueError, struct.error, mmap.error): pass
+	if os.path.exists(db):
+		con = sqlite3.connect(db)
+	elif not idx and not _warned:
 		sys.stderr.write('WARNING: No station database found, please run stations/createdb.py\n')
-		return
-	# for convenience also warn if any file in stations is newer than database file
-	dbtime = os.path.getmtime(db)
-	for filename in os.listdir(os.path.dirname(db)):
-		if not filename.endswith('.tsv') or filename.endswith('.sql'): continue
-		ftime = os.path.getmtime(os.path.join(os.path.dirname(db), filename))
-		if ftime > dbtime:
-			sys.stderr.write('WARNING: Station database older than its source files, ')
-			sys.stderr.write('you may want to rerun stations/createdb.py\n')
-	con = sqlite3.connect(db)
+		_warned = True
+
+def _load(company=None):
+	'''load all stations, or all stations of a company, into the cache'''
+	global _names
+	cur = con.cursor()
+	if company is None:
+		cur.execute('SELECT * FROM stations')
+	else:
+		cur.execute('SELECT * FROM stations WHERE company=?', (company,))
+	# rows are only turned into station objects when looked up
+	_names = [x[0] for x in cur.description]
+	icompany, iovcid = _names.index('company'), _names.index('ovcid')
+	_cache.update([((row[icompany], row[iovcid]), row) for row in cur])
+	# precompute maximum title lengths as well
+	if company is None:
+		_loaded.add(None)
+		cur.execute('SELECT company, MAX(LENGTH(title)) FROM stations GROUP BY company')
+		widths = dict([(c, w or 0) for c, w in cur])
+		_maxlen.update([(('title', c), w) for c, w in widths.iteritems()])
+		_maxlen[('title', None)] = max(widths.values() or [0])
+	else:
+		_loaded.add(company)
+		cur.execute('SELECT MAX(LENGTH(title)) FROM stations WHERE company=?', (company,))
+		_maxlen[('title', company)] = cur.fetchone()[0] or 0
+
+def _station(key):
+	'''return cached station, creating the station object from a loaded row'''
+	s = _cache[key]
+	if isinstance(s, tuple):
+		s = _cache[key] = OvcStation(dict(zip(_names, s)))
+	return s
 
 def get(company, number):
 	'''return station object by number'''
-	global con
-	if not con: init()
-	if not con: return None
+	key = (company, number)
+	try: s = _station(key)
+	except KeyError: pass
+	else:
+		if stats.current is not None: stats.current.station_hits += 1
+		return s
+	if stats.current is None: return _lookup(company, number)
+	t = stats.timer()
+	s = _lookup(company, number)
+	stats.current.station_misses += 1
+	stats.current.times['lookup'] += stats.timer() - t
+	return s
+
+def _lookup(company, number):
+	'''return station object by number that is not in the cache, and cache it'''
+	key = (company, number)
+	if not con and not idx: init(db, _preload, _cachesize)
+	if not con:
+		# only the index is there, without the other fields
+		s = _cache[key] = idx and idx.get(company, number) or None
+		return s
+	if _preload == 'all' and None not in _loaded: _load()
+	elif _preload == 'company' and company not in _loaded: _load(company)
+	# stations of loaded companies are all cached, unless evicted
+	if (None in _loaded or company in _loaded) and _cachesize is None:
+		if key in _cache: return _station(key)
+		_cache[key] = None
+		return None
+	if key in _cache: return _station(key)
 	cur = con.cursor()
 	cur.execute('SELECT * FROM stations WHERE company=? AND ovcid=?', (company, number))
 	row = cur.fetchone()
-	if not row: return None
-	return OvcStation(dict(zip([x[0] for x in cur.description], row)))
+	s = None
+	if row: s = OvcStation(dict(zip([x[0] for x in cur.description], row)))
+	_cache[key] = s
+	return s
+
+def title(company, number):
+	'''return station title by number, or None. Titles are read from the
+	compact index when there is one, without loading the other fields.'''
+	if not con and not idx: init(db, _preload, _cachesize)
+	if not idx:
+		s = get(company, number)
+		return s and s.title or None
+	key = (company, number)
+	try: t = _titles[key]
+	except KeyError: pass
+	else:
+		if stats.current is not None: stats.current.station_hits += 1
+		return t
+	if stats.current is None:
+		t = _titles[key] = idx.title(company, number)
+		return t
+	tm = stats.timer()
+	t = _titles[key] = idx.title(company, number)
+	stats.current.station_misses += 1
+	stats.current.times['lookup'] += stats.timer() - tm
+	return t
+
+def numbers():
+	'''return list of (company, ovcid) of all stations in the database'''
+	if not con and not idx: init(db, _preload, _cachesize)
+	if idx: return idx.keys()
+	if not con: return []
+	return con.execute('SELECT company, ovcid FROM stations ORDER BY company, ovcid').fetchall()
 
 def get_max_len(field='title', company=None):
 	'''return maximum length of station names'''
 	global con
-	if not con: init()
-	if not con: return 0
+	try: return _maxlen[(field, company)]
+	except KeyError: pass
+	if not con and not idx: init(db, _preload, _cachesize)
+	if idx and field == 'title':
+		if company is None: _maxlen[(field, company)] = max(idx.widths.values() or [0])
+		else: _maxlen[(field, company)] = idx.widths.get(company, 0)
+		return _maxlen[(field, company)]
+	if not con and os.path.exists(db): con = sqlite3.connect(db)
+	if not con:
+		_maxlen[(field, company)] = 0
+		return 0
 	where=''
 	if company is not None: where = 'WHERE company=%d'%company
 	cur = con.cursor()
 	cur.execute('SELECT MAX(LENGTH(%s)) FROM stations %s'%(field, where))
-	return int(cur.fetchone()[0])
+	_maxlen[(field, company)] = int(cur.fetchone()[0] or 0)
+	return _maxlen[(field, company)]
+
 
+class _LruDict:
+	'''dict holding at most size items, evicting least recently used ones'''
+	def __init__(self, size):
+		self.size = size
+		self._d = OrderedDict()
+	def __len__(self):
+		return len(self._d)
+	def __contains__(self, key):
+		return key in self._d
+	def __getitem__(self, key):
+		value = self._d.pop(key)
+		self._d[key] = value
+		return value
+	def get(self, key, default=None):
+		try: return self[key]
+		except KeyError: return default
+	def __setitem__(self, key, value):
+		if key in self._d: del self._d[key]
+		elif len(self._d) >= self.size: self._d.popitem(last=False)
+		self._d[key] = value
+	def update(self, items):
+		for key, value in items: self[key] = value
@@ -0,0 +1,149 @@
+#
+# OV-chipkaart decoder: decode statistics
+#
+# Counts matched templates, unparsed records and station lookups, and
+# times the stages of decoding. Statistics are only gathered while they
+# are enabled; when disabled, decoding only checks whether they are.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import timeit
+
+timer = timeit.default_timer
+
+'''Stages of decoding that are timed. Rendering includes the station
+lookups done for text output.'''
+STAGES = ['io', 'match', 'typing', 'lookup', 'render']
+
+
+class OvcStats:
+	'''Statistics of decoding'''
+
+	'''Number of leading bytes of unparsed records shown by __str__'''
+	maxunparsed = 20
+
+	def __init__(self):
+		self.dumps = 0
+		'''number of records by class name'''
+		self.records = {}
+		'''by (class name, template index): [tried, matched, used]; tried
+		counts records compared with the template, matched those matching
+		it and used those decoded with it. Templates after the first one
+		matching a record are not tried.'''
+		self.templates = {}
+		'''number of unparsed records by (class name, leading byte)'''
+		self.unparsed = {}
+		'''station cache hits and misses'''
+		self.station_hits = 0
+		self.station_misses = 0
+		'''seconds spent by stage'''
+		self.times = dict.fromkeys(STAGES, 0.0)
+
+	def template(self, cls, index):
+		'''Return counters of a template'''
+		key = (cls.__name__, index)
+		counts = self.templates.get(key)
+		if counts is None: counts = self.templates[key] = [0, 0, 0]
+		return counts
+
+	def record(self, cls, data, index):
+		'''Count record of class decoded with template index, None if unparsed'''
+		name = cls.__name__
+		self.records[name] = self.records.get(name, 0) + 1
+		if index is None:
+			key = (name, len(data) and ord(data[0]) or None)
+			self.unparsed[key] = self.unparsed.get(key, 0) + 1
+		else:
+			self.template(cls, index)[2] += 1
+
+	def merge(self, other):
+		'''Add statistics of other to these'''
+		self.dumps += other.dumps
+		for name, n in other.records.iteritems():
+			self.records[name] = self.records.get(name, 0) + n
+		for key, counts in other.templates.iteritems():
+			mine = self.templates.setdefault(key, [0, 0, 0])
+			for i in range(len(counts)): mine[i] += counts[i]
+		for key, n in other.unparsed.iteritems():
+			self.unparsed[key] = self.unparsed.get(key, 0) + n
+		self.station_hits += other.station_hits
+		self.station_misses += other.station_misses
+		for stage, t in other.times.iteritems():
+			self.times[stage] = self.times.get(stage, 0.0) + t
+
+	def asdict(self):
+		'''Return statistics as dict of plain values'''
+		return {
+			'dumps':     self.dumps,
+			'records':   dict(self.records),
+			'templates': [{'class': name, 'template': index, 'tried': c[0], 'matched': c[1], 'used': c[2]}
+			              for (name, index), c in sorted(self.templates.iteritems())],
+			'unparsed':  [{'class': name, 'byte': byte, 'count': n}
+			              for (name, byte), n in sorted(self.unparsed.iteritems())],
+			'stations':  {'hits': self.station_hits, 'misses': self.station_misses},
+			'times':     dict(self.times),
+		}
+
+	def __str__(self):
+		lines = []
+		unparsed = sum(self.unparsed.values())
+		lines.append('dumps: %d, records: %d, unparsed: %d'%(self.dumps, sum(self.records.values()), unparsed))
+		lines.append('%-24s %2s %9s %9s %9s'%('templates:', '', 'tried', 'matched', 'used'))
+		for (name, index), (tried, matched, used) in sorted(self.templates.iteritems()):
+			lines.append('  %-22s %2d %9d %9d %9d'%(name, index, tried, matched, used))
+		if self.unparsed:
+			lines.append('unparsed records by leading byte (most frequent):')
+			unparsed = sorted(self.unparsed.iteritems(), key=lambda x: (-x[1], x[0]))
+			for (name, byte), n in unparsed[:self.maxunparsed]:
+				byte = byte is None and '-' or '%02x'%byte
+				lines.append('  %-22s %2s %9d'%(name, byte, n))
+			if len(unparsed) > self.maxunparsed:
+				lines.append('  (%d more)'%(len(unparsed)-self.maxunparsed))
+		lookups = self.station_hits + self.station_misses
+		lines.append('station cache: %d hits, %d misses (%.1f%% hits)'%(
+			self.station_hits, self.station_misses, lookups and 100.0*self.station_hits/lookups or 0))
+		lines.append('time: ' + ', '.join(['%s %.3fs'%(x, self.times.get(x, 0)) for x in STAGES]))
+		return '\n'.join(lines)
+
+
+'''Statistics being gathered, or None when disabled'''
+current = None
+
+def enable():
+	'''Start gathering statistics, return them'''
+	global current
+	current = OvcStats()
+	return current
+
+def disable():
+	'''Stop gathering statistics, return them'''
+	global current
+	s, current = current, None
+	return s
+
+def timed(iterable, stage):
+	'''Iterate over iterable, adding time spent in it to stage when enabled'''
+	if current is None: return iterable
+	return _timed(iter(iterable), stage)
+
+def _timed(it, stage):
+	while True:
+		t = timer()
+		try: item = it.next()
+		except StopIteration: return
+		finally:
+			if current is not None: current.times[stage] += timer() - t
+		yield item
@@ -0,0 +1,154 @@
+#
+# OV-chipkaart decoder: streaming of dump files
+#
+# Reads card dumps from concatenated dump files and tar archives one at a
+# time, so that memory use doesn't depend on the size of the input.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#        
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import os
+import sys
+import stat
+import tarfile
+
+import stats
+from card import OvcCard
+
+'''Sizes of dumps: mifare classic 4k and mifare ultralight'''
+FRAMESIZES = [4096, 64]
+
+_tarexts = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2']
+
+
+class _PeekedFile:
+	'''File object with data read ahead put back in front'''
+	def __init__(self, head, f):
+		self.head = head
+		self.f = f
+	def read(self, size=-1):
+		if not self.head: return self.f.read(size)
+		if size < 0:
+			data, self.head = self.head + self.f.read(), ''
+		elif size <= len(self.head):
+			data, self.head = self.head[:size], self.head[size:]
+		else:
+			data, self.head = self.head + self.f.read(size-len(self.head)), ''
+		return data
+
+
+def iter_dumps(source, framesize=None, tar=None):
+	'''Iterate over (name, data) of dumps in a file.
+
+	source is a filename, '-' for stdin, or a file object. It can be a
+	single dump, dumps concatenated or a tar archive of dumps (detected
+	by extension or header, or forced with tar). Concatenated dumps are
+	read in frames of framesize bytes; by default this is 4096 unless the
+	size of the file is a multiple of 64 only. Frames are named after the
+	source with their index appended, unless the file is a single dump.
+	A short last frame is returned as well, to be rejected by the decoder.'''
+	if isinstance(source, basestring):
+		name = source
+		if source == '-': f = sys.stdin
+		else: f = open(source, 'rb')
+	else:
+		name = getattr(source, 'name', '-')
+		f = source
+	try:
+		if tar is None:
+			tar = [x for x in _tarexts if name.endswith(x)] != []
+		head = ''
+		if not tar:
+			head = f.read(512)
+			tar = len(head) == 512 and head[257:262] == 'ustar'
+		if tar:
+			for item in _iter_tar(name, _PeekedFile(head, f)): yield item
+			return
+		# determine frame size from file size, if known
+		size = None
+		try:
+			st = os.fstat(f.fileno())
+			if stat.S_ISREG(st.st_mode): size = st.st_size - f.tell() + len(head)
+		except (AttributeError, IOError, OSError):
+			pass
+		if framesize is None:
+			framesize = FRAMESIZES[0]
+			if size is not None:
+				for x in FRAMESIZES:
+					if not size%x:
+						framesize = x
+						break
+		if size is not None and size <= framesize:
+			yield name, head + f.read()
+			return
+		inp = _PeekedFile(head, f)
+		i = 0
+		while True:
+			data = inp.read(framesize)
+			if not data: break
+			yield '%s:%d'%(name, i), data
+			i += 1
+	finally:
+		if f is not sys.stdin and f is not source: f.close()
+
+def _iter_tar(name, f):
+	'''Iterate over (name, data) of regular files in a streamed tar archive'''
+	archive = tarfile.open(fileobj=f, mode='r|*')
+	try:
+		for member in archive:
+			if not member.isreg(): continue
+			yield '%s:%s'%(name, member.name), archive.extractfile(member).read()
+	finally:
+		archive.close()
+
+def iter_cards(source, framesize=None, tar=None):
+	'''Iterate over (name, OvcCard) of dumps in a file, see iter_dumps()'''
+	for name, data in iter_dumps(source, framesize, tar):
+		yield name, OvcCard(data)
+
+def iter_records(source, framesize=None, tar=None):
+	'''Iterate over (name, card, record) of all dumps in a file, see iter_dumps()'''
+	for name, card in iter_cards(source, framesize, tar):
+		for record in card.records():
+			yield name, card, record
+
+
+def find_files(args, filelist=None):
+	'''Return dump files from arguments, descending into directories'''
+	files = []
+	if filelist:
+		if filelist == '-': f = sys.stdin
+		else: f = open(filelist, 'r')
+		args = [x.rstrip('\r\n') for x in f if x.strip()] + args
+		if f is not sys.stdin: f.close()
+	for arg in args:
+		if not os.path.isdir(arg):
+			files.append(arg)
+			continue
+		for dirpath, dirnames, filenames in os.walk(arg):
+			dirnames.sort()
+			files += [os.path.join(dirpath, x) for x in sorted(filenames)]
+	return files
+
+def read_dumps(files, framesize=None):
+	'''Iterate over (name, data, error) of dumps in files'''
+	for fn in files:
+		try:
+			for name, data in stats.timed(iter_dumps(fn, framesize), 'io'):
+				yield name, data, None
+		except (IOError, OSError), e:
+			yield fn, None, e.strerror or str(e)
+		except tarfile.TarError, e:
+			yield fn, None, str(e)
@@ -0,0 +1,162 @@
+#
+# OV-chipkaart decoder: synthetic card dumps
+#
+# Generates dumps with random but plausible contents, by encoding field
+# values through the templates of the record classes. Useful for testing
+# and benchmarking without real dumps.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import os
+import random
+from binascii import hexlify
+
+from ovctypes import *
+from ovcrecord import *
+from card import LAYOUTS
+
+
+def setbits(data, start, end, value):
+	'''Set bit positions of bytearray data to number (msb first)'''
+	first, last = start/8, (end+7)/8
+	shift = last*8 - end
+	mask = ((1L<<(end-start))-1) << shift
+	old = long(hexlify(data[first:last]) or '0', 16)
+	new = (old & ~mask) | ((value << shift) & mask)
+	data[first:last] = ('%0*x'%((last-first)*2, new)).decode('hex')
+
+
+class OvcSynth:
+	'''Generator of synthetic card dumps.
+
+	Transaction ids increase on each card, dates lie in 2009-2011, and
+	companies, transfers and subscriptions are known ones. Stations are
+	taken from stations, a list of (company, ovcid), when given. A fraction
+	junk of the slots holds random data that matches no template.'''
+
+	'''first and last day of dates, in days since 1997'''
+	days = (4383, 5477)
+
+	def __init__(self, seed=None, stations=None, junk=0.05):
+		self.random = random.Random(seed)
+		self.junk = junk
+		self.stations = {}
+		for company, ovcid in stations or []:
+			self.stations.setdefault(company, []).append(ovcid)
+		self._id = 0
+
+	def value(self, ftype, mask, company=None):
+		'''Return random raw value for a field of type ftype'''
+		r = self.random
+		if ftype is OvcTransactionId or ftype is OvcSaldoTransactionId:
+			self._id += 1
+			return self._id
+		if ftype is OvcDatetime:
+			return r.randint(*self.days)<<11 | r.randint(5*60, 24*60-1)
+		if ftype is OvcDate:
+			return r.randint(*self.days)
+		if ftype is OvcCompany:
+			return r.choice(OvcCompany._strs.keys())
+		if ftype is OvcTransfer:
+			return r.choice(OvcTransfer._strs.keys())
+		if ftype is OvcAmount:
+			return r.randint(0, 50)*10
+		if ftype is OvcAmountSigned:
+			return (1<<15) + r.randint(-500, 5000)
+		if ftype is OvcStation and self.stations.get(company):
+			return r.choice(self.stations[company])
+		if ftype is OvcSubscription and OvcSubscription._strs.get(company):
+			return r.choice(OvcSubscription._strs[company].keys())
+		return r.getrandbits(64) & mask
+
+	def record(self, cls, size, template=None):
+		'''Return data of a record of cls with random field values, padded
+		to size bytes; or None when no template fits'''
+		plans = cls._compile().plans
+		if template is None:
+			plans = [x for x in plans if x.length <= size]
+			if not plans: return None
+			plan = self.random.choice(plans)
+		else:
+			plan = plans[template]
+		company = None
+		if plan.company: company = self.value(OvcCompany, plan.company[1])
+		bits = 0L
+		for pos, shift, mask, ftype, width in plan.extract:
+			if ftype is OvcCompany: value = company
+			else: value = self.value(ftype, mask, company)
+			bits |= (value & mask) << shift
+		bits = (bits & ~plan.mask) | plan.value
+		data = ('%0*x'%(plan.size*2, bits)).decode('hex')[:plan.length]
+		return data + '\0'*(size-len(data))
+
+	def junkrecord(self, size):
+		'''Return random data of size bytes, starting with a non-zero byte'''
+		r = self.random
+		return chr(r.randint(1, 255)) + ''.join([chr(r.getrandbits(8)) for i in range(size-1)])
+
+	def card(self, layout, fill=0.75):
+		'''Return dump of a card of layout, a fraction fill of its slots used'''
+		r = self.random
+		self._id = r.randint(0, 100)
+		if layout.size == 4096: data = bytearray(layout.size)
+		else: data = bytearray(self.junkrecord(layout.size))
+		# header
+		values = {
+			'cardid':     r.getrandbits(32),
+			'cardtype':   r.choice([0, 2, 2]),
+			'validuntil': r.randint(*self.days) + 5*365,
+			'birthdate':  int('%04d%02d%02d'%(r.randint(1930, 2000), r.randint(1, 12), r.randint(1, 28)), 16),
+		}
+		for name, (start, end, ftype, condition) in layout.header.iteritems():
+			if condition and values[condition[0]] != condition[1]: continue
+			setbits(data, start, end, values[name])
+		# records
+		for start, end, cls in layout.slots:
+			sdata = None
+			if r.random() < self.junk: sdata = self.junkrecord(end-start)
+			elif r.random() < fill: sdata = self.record(cls, end-start)
+			if sdata is None or sdata.startswith(layout.empty):
+				sdata = layout.empty + '\0'*(end-start-len(layout.empty))
+			data[start:end] = sdata
+		return str(data)
+
+	def classic(self, fill=0.75):
+		'''Return dump of a mifare classic 4k card'''
+		return self.card(LAYOUTS[4096], fill)
+
+	def ultralight(self, fill=0.8):
+		'''Return dump of a mifare ultralight card'''
+		return self.card(LAYOUTS[64], fill)
+
+	def cards(self, n, ultralight=0.2):
+		'''Iterate over n dumps, a fraction ultralight of them ultralight cards'''
+		for i in range(n):
+			if self.random.random() < ultralight: yield self.ultralight()
+			else: yield self.classic()
+
+
+def write_corpus(directory, n, seed=None, stations=None, ultralight=0.2):
+	'''Write n synthetic dumps to files in directory, return their names'''
+	if not os.path.isdir(directory): os.makedirs(directory)
+	synth = OvcSynth(seed, stations)
+	files = []
+	for i, data in enumerate(synth.cards(n, ultralight)):
+		files.append(os.path.join(directory, 'synth%05d.mfd'%i))
+		f = open(files[-1], 'wb')
+		f.write(data)
+		f.close()
+	return files
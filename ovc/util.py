@@ -18,27 +18,62 @@
 # (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
 #
 
+from binascii import hexlify
+
+
 def getbits(data, start, end):
-	'''Return number at bit positions of bytestring data (msb first)'''
-	val = 0L
-	for byte in range(start/8, (end+7)/8):
-		bits = 8
-		if byte*8 > end-8: bits = end - byte*8
-		mask = 0xff
-		if byte == start/8: mask = (1<<(8-start%8))-1
-		val = (val << bits) + ((ord(data[byte])>>(8-bits)) & mask)
-	return val
+	'''Return number at bit positions of data (msb first).
+	data can be any buffer: a string, bytearray or memoryview; bytes beyond
+	its end are zero.
+	Note that when the range lies within a single byte and neither starts
+	nor ends on a byte boundary, the bits before start are included as
+	well, as far as they fit in the width of the range.'''
+	first, last = start/8, (end+7)/8
+	if first == (end-1)/8 and start%8 and end%8:
+		start = start - start%8 + max(0, start%8 + end%8 - 8)
+	chunk = data[first:last]
+	val = long(hexlify(chunk) or '0', 16) << (last-first-len(chunk))*8
+	return (val >> (last*8-end)) & ((1L<<(end-start))-1)
+
+def nonzerolen(data):
+	'''Return length of buffer without trailing zero bytes'''
+	n = len(data)
+	while n and data[n-1] == '\0': n -= 1
+	return n
+
+def tobytes(data):
+	'''Return buffer as string, without copying when it is one already'''
+	if isinstance(data, memoryview): return data.tobytes()
+	return str(data)
 
 def mfclassic_getsector(data, sector):
-	'''Retrieve sector from mifare classic dump'''
+	'''Retrieve sector from mifare classic dump, as memoryview of data'''
 	if sector < 32:
 		length = 0x40
 		addr = sector*length
 	else:
 		length = 0x100
 		addr = 0x800 + (sector-32)*length
-	return data[addr:addr+length]
+	return memoryview(data)[addr:addr+length]
+
+def _bcdtable():
+	table = [None]*256
+	for hi in range(10):
+		for lo in range(10):
+			table[hi<<4 | lo] = hi*10 + lo
+	return table
+
+'''Value of each byte as two binary-coded decimal digits, None when it isn't'''
+BCD = _bcdtable()
 
 def bcd2int(x):
-	return int('%x'%x)
+	'''Return value of binary-coded decimal number, a byte at a time'''
+	n, scale = 0, 1
+	while True:
+		digits = BCD[x & 0xff]
+		if digits is None: raise ValueError('not a binary-coded decimal number: %x'%x)
+		n += digits*scale
+		x >>= 8
+		if not x: return n
+		scale *= 100
 
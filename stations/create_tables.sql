@@ -12,15 +12,21 @@ CREATE TABLE stations_data (
                 zone INT,				-- dutch public transport zone
                 lon FLOAT,				-- longitude
                 lat FLOAT,				-- lattitude
+		title VARCHAR(170),			-- display title, set by createdb.py
+		source VARCHAR(50),			-- data file this station was imported from
                 PRIMARY KEY (company, ovcid)
         );
 
--- stations view with title based on available fields in stations_data
+-- stations view, kept for compatibility now that title is a column
 CREATE VIEW stations AS
-	SELECT	*,
-		(CASE company
-			WHEN 4 THEN name
-			ELSE COALESCE(longname, city||', '||name, name)
-		END) AS title
-	 FROM stations_data;
+	SELECT	* FROM stations_data;
 
+-- source files imported, to only import changed files again
+CREATE TABLE sources (
+		filename VARCHAR(50) PRIMARY KEY,	-- data or sql file
+		mtime FLOAT,				-- modification time at import
+		size INT,				-- size at import
+		checksum VARCHAR(40),			-- sha1 of contents at import
+		fields TEXT,				-- fields of data file at import, tab-separated
+		lines BLOB				-- sha1 start, company and ovcid of its lines, see createdb.py
+        );
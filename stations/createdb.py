@@ -1,41 +1,90 @@
 #!/usr/bin/env python
+#
+# Creates or updates the station database from the sql and tab-separated
+# data files in this directory. Only files that changed since the last run
+# are imported again, and of these only the rows that changed, unless a
+# rebuild is requested.
+#
 
 import os
-import sys
+import struct
 import sqlite3
+import hashlib
+import optparse
 
 # name of database
 dbname = 'stations.sqlite'
+# name of compact station index, see write_index()
+idxname = 'stations.idx'
 # sql file to create tables
 createsql = 'create_tables.sql'
 # default table for importing data files
 dfltable = 'stations_data'
+# table with imported source files
+srctable = 'sources'
+# title of stations, based on available fields
+titlesql = '''UPDATE %s SET title =
+		(CASE company
+			WHEN 4 THEN name
+			ELSE COALESCE(longname, city||', '||name, name)
+		END)'''%dfltable
 
-prefix = os.path.dirname(__file__)
+prefix = os.path.dirname(os.path.abspath(__file__))
 db = os.path.join(prefix, dbname)
+idx = os.path.join(prefix, idxname)
 
 def dbconnect(_db = None):
 	'''open connection to database'''
 	global db
 	if not _db: _db = db
 	con = sqlite3.connect(_db)
+	con.isolation_level = None
+	# the database can always be rebuilt from its sources, so favour speed
+	con.executescript('''
+		PRAGMA synchronous = OFF;
+		PRAGMA cache_size = -65536;
+	''')
 	return con
 
-def tsv_each(filename):
-	'''iterate over lines in tsv file'''
-	f = open(filename, 'r')
-	fields = None
-	for line in f:
-		if line.startswith('#'): continue
-		try: line = line[:line.index('#')]
-		except ValueError: pass
-		data = [x.strip() for x in line.decode('utf-8').split('\t')]
-		if not fields:
-			fields = data
-		else:
-			# remove empty fields
-			yield dict(filter(lambda x:x[1]!='', zip(fields, data)))
-	f.close()
+def tsv_values(line):
+	'''return values of a line of a tsv file, empty values are None; or None
+	for comments and lines without values'''
+	if line.startswith('#'): return None
+	try: line = line[:line.index('#')]
+	except ValueError: pass
+	data = [x.strip() or None for x in line.split('\t')]
+	if data == [None]*len(data): return None
+	return data
+
+def tsv_fields(lines):
+	'''return fields of lines of a tsv file, the values of its first line'''
+	for line in lines:
+		data = tsv_values(line)
+		if data is not None: return data
+	return None
+
+def line_digest(line):
+	'''return start of the sha1 of a line of a tsv file, to recognise it'''
+	return hashlib.sha1(line.encode('utf-8')).digest()[:8]
+
+def tsv_lines(lines, fields):
+	'''return list of (digest, row) of lines of a tsv file, skipping its fields'''
+	result = []
+	for line in lines:
+		data = tsv_values(line)
+		if data is None or data == fields: continue
+		result.append((line_digest(line), (data + [None]*len(fields))[:len(fields)]))
+	return result
+
+def pack_lines(keys):
+	'''return dict of line digest to (company, ovcid) packed in a string of
+	16 bytes per line, for storing with the source'''
+	return ''.join([x + struct.pack('<2I', *keys[x]) for x in keys])
+
+def unpack_lines(packed):
+	'''return dict of line digest to (company, ovcid) from pack_lines()'''
+	packed = str(packed)
+	return dict([(packed[i:i+8], struct.unpack('<2I', packed[i+8:i+16])) for i in range(0, len(packed), 16)])
 
 def readfile(filename):
 	'''return contents of textfile'''
@@ -44,50 +93,210 @@ def readfile(filename):
 	f.close()
 	return r
 
+def checksum(filename):
+	'''return sha1 of file contents'''
+	return hashlib.sha1(readfile(filename)).hexdigest()
+
+def changed_sources(con, filenames):
+	'''return dict of filename to (mtime, size, checksum) for files that
+	changed since their last import, and list of files no longer present'''
+	known = {}
+	try:
+		for row in con.execute('SELECT filename, mtime, size, checksum FROM %s'%srctable):
+			known[row[0]] = row[1:]
+	except sqlite3.OperationalError:
+		pass
+	changed = {}
+	for filename in filenames:
+		path = os.path.join(prefix, filename)
+		mtime, size = os.path.getmtime(path), os.path.getsize(path)
+		old = known.get(filename)
+		if old and old[0] == mtime and old[1] == size: continue
+		csum = checksum(path)
+		if old and old[2] == csum:
+			# only touched, remember new time
+			con.execute('UPDATE %s SET mtime=?, size=? WHERE filename=?'%srctable, (mtime, size, filename))
+			continue
+		changed[filename] = (mtime, size, csum)
+	removed = [x for x in known if x not in filenames]
+	return changed, removed
+
+def import_tsv(cur, filename, previous=None):
+	'''import tab-separated file; first line are fields,
+	hash '#' at start of a line is a comment. With previous, the fields and
+	packed lines stored at the import before, only rows of lines removed
+	since are deleted and rows of lines added are inserted. Return tuple of
+	fields and packed lines to store, number of rows deleted and inserted,
+	and whether keys, titles or locations changed.'''
+	lines = readfile(os.path.join(prefix, filename)).decode('utf-8').splitlines()
+	fields = tsv_fields(lines)
+	icompany, iovcid = fields.index('company'), fields.index('ovcid')
+	def key(row):
+		return int(row[icompany]), int(row[iovcid])
+	if previous is None or previous[0] != '\t'.join(fields):
+		rows = tsv_lines(lines, fields)
+		keys = dict([(digest, key(row)) for digest, row in rows])
+		cur.execute('DELETE FROM %s WHERE source=?'%dfltable, (filename,))
+		deleted = cur.rowcount
+		inserted = insert_rows(cur, filename, fields, [row for digest, row in rows])
+		return '\t'.join(fields), buffer(pack_lines(keys)), deleted, inserted, True
+	# only lines not imported before need parsing
+	old = unpack_lines(previous[1])
+	digests = [line_digest(x) for x in lines]
+	removed = [old[x] for x in set(old).difference(digests)]
+	added = tsv_lines([x for x, digest in zip(lines, digests) if digest not in old], fields)
+	keys = dict([(x, old[x]) for x in digests if x in old] + [(digest, key(row)) for digest, row in added])
+	def indexed(keys):
+		'''return sorted index fields of the stations of keys'''
+		query = 'SELECT company, ovcid, title, lon, lat FROM %s WHERE source=? AND company=? AND ovcid=?'%dfltable
+		return sorted([x for k in keys for x in cur.execute(query, (filename,) + k).fetchall()])
+	before = indexed(removed)
+	cur.executemany('DELETE FROM %s WHERE source=? AND company=? AND ovcid=?'%dfltable,
+		[(filename,) + k for k in removed])
+	deleted = removed and cur.rowcount or 0
+	inserted = insert_rows(cur, filename, fields, [row for digest, row in added])
+	after = indexed([key(row) for digest, row in added])
+	return previous[0], buffer(pack_lines(keys)), deleted, inserted, after != before
+
+def insert_rows(cur, filename, fields, rows):
+	'''insert rows of tab-separated file, return number of rows'''
+	for row in rows: row.append(filename)
+	query = 'INSERT INTO %s (%s) VALUES (%s);'%(
+			dfltable,
+			','.join(fields + ['source']),
+			','.join(['?'] * (len(fields)+1)),
+		)
+	cur.executemany(query, rows)
+	cur.execute(titlesql + ' WHERE source=? AND title IS NULL', (filename,))
+	return len(rows)
+
+def write_index(con, filename):
+	'''write compact binary station index, for memory-mapping by ovc.stations.
+	All numbers are little-endian; with n stations and m companies:
+	  header    magic 'OVCSTIX1', n, m, blob length (uint32)
+	  keys      n sorted keys company<<32|ovcid (uint64)
+	  offsets   n+1 offsets of titles in blob (uint32)
+	  lon, lat  n longitudes and n lattitudes, NaN when unknown (float64)
+	  widths    m pairs of company and maximum title length (uint32)
+	  blob      utf-8 encoded titles'''
+	rows = con.execute('SELECT company, ovcid, title, lon, lat FROM %s ORDER BY company, ovcid'%dfltable).fetchall()
+	keys, offsets, lons, lats, widths = [], [0], [], [], {}
+	blob = []
+	bloblen = 0
+	for company, ovcid, title, lon, lat in rows:
+		keys.append(company<<32 | ovcid)
+		title = (title or u'')
+		widths[company] = max(widths.get(company, 0), len(title))
+		title = title.encode('utf-8')
+		blob.append(title)
+		bloblen += len(title)
+		offsets.append(bloblen)
+		lons.append(lon is None and float('nan') or lon)
+		lats.append(lat is None and float('nan') or lat)
+	n, m = len(keys), len(widths)
+	# write to temporary file and rename, so readers never see a partial index
+	f = open(filename + '.tmp', 'wb')
+	f.write(struct.pack('<8s3I', 'OVCSTIX1', n, m, bloblen))
+	f.write(struct.pack('<%dQ'%n, *keys))
+	f.write(struct.pack('<%dI'%(n+1), *offsets))
+	f.write(struct.pack('<%dd'%n, *lons))
+	f.write(struct.pack('<%dd'%n, *lats))
+	f.write(struct.pack('<%dI'%(2*m), *[x for c in sorted(widths) for x in (c, widths[c])]))
+	f.write(''.join(blob))
+	f.close()
+	os.rename(filename + '.tmp', filename)
+
 
 if __name__ == '__main__':
 
-	if os.path.exists(db):
-		sys.stderr.write('Please remove database file first: %s\n'%db)
-		sys.exit(1)
+	parser = optparse.OptionParser()
+	parser.add_option('-r', '--rebuild', dest='rebuild', action='store_true', default=False,
+		help='Recreate database from scratch instead of importing changed files only')
+	parser.add_option('--no-index', dest='index', action='store_false', default=True,
+		help='Don\'t write compact station index %s'%idxname)
+	(options, args) = parser.parse_args()
 
-	con = dbconnect()
-	cur = con.cursor()
-	# performance improvements
-	cur.executescript('''
-		PRAGMA journal_mode = OFF;
-		PRAGMA locking_mode = EXCLUSIVE;
-	''')
+	sqlfiles = sorted([x for x in os.listdir(prefix) if x.endswith('.sql')])
+	tsvfiles = sorted([x for x in os.listdir(prefix) if x.endswith('.tsv')])
+
+	con = None
+	if os.path.exists(db) and not options.rebuild:
+		con = dbconnect()
+		if not con.execute("SELECT name FROM sqlite_master WHERE name=?", (srctable,)).fetchone():
+			print 'Database from older version, rebuilding database'
+			options.rebuild = True
+		else:
+			changed, removed = changed_sources(con, sqlfiles + tsvfiles)
+			# sql files can't be undone, so any change there requires a rebuild
+			if [x for x in changed.keys() + removed if x.endswith('.sql')]:
+				print 'SQL files changed, rebuilding database'
+				options.rebuild = True
+		if options.rebuild:
+			con.close()
+			con = None
+	if con is None:
+		if os.path.exists(db): os.unlink(db)
+		con = dbconnect()
+		# performance improvements
+		con.executescript('''
+			PRAGMA journal_mode = OFF;
+			PRAGMA locking_mode = EXCLUSIVE;
+		''')
+		# create table first
+		print 'Creating table'
+		con.executescript(readfile(os.path.join(prefix, createsql)))
+		changed, removed = changed_sources(con, sqlfiles + tsvfiles)
 
-	# create table first
-	print 'Creating table'
-	cur.executescript(readfile(os.path.join(prefix, createsql)))
+	cur = con.cursor()
+	# whether keys, titles or locations changed, so that the index needs writing
+	modified = options.rebuild or bool(removed)
 
 	# then import all other sql files
-	for filename in os.listdir(prefix):
-		if not filename.endswith('.sql'): continue
-		if filename == createsql: continue
+	for filename in sqlfiles:
+		if filename == createsql or filename not in changed: continue
 		print 'Importing SQL: %s'%filename
 		cur.executescript(readfile(os.path.join(prefix, filename)))
+		cur.execute(titlesql)
+		modified = True
 
-	# and import tab-separated files; first line are fields,
-	# hash '#' at start of a line is a comment
-	for filename in os.listdir(prefix):
-		if not filename.endswith('.tsv'): continue
-		print 'Importing tab-separated data: %s'%filename
-		for fields in tsv_each(os.path.join(prefix, filename)):
-			query = 'INSERT INTO %s (%s) VALUES (%s);'%(
-					dfltable,
-					','.join(fields.keys()),
-					','.join(['?'] * len(fields.values())),
-				)
-			cur.execute(query, fields.values())
-		
-	# compact database
-	print 'Compacting database'
-	cur.executescript('''
-		VACUUM;
-	''')
+	# import data in a single transaction
+	cur.execute('BEGIN')
 
-	print 'Done!'
+	# and import changed tab-separated files, replacing rows that changed
+	imported = {}
+	for filename in removed:
+		print 'Removing tab-separated data: %s'%filename
+		cur.execute('DELETE FROM %s WHERE source=?'%dfltable, (filename,))
+		cur.execute('DELETE FROM %s WHERE filename=?'%srctable, (filename,))
+	for filename in tsvfiles:
+		if filename not in changed: continue
+		previous = cur.execute('SELECT fields, lines FROM %s WHERE filename=?'%srctable, (filename,)).fetchone()
+		if previous is not None and previous[0] is None: previous = None
+		fields, lines, deleted, inserted, indexchanged = import_tsv(cur, filename, previous)
+		imported[filename] = (fields, lines)
+		print 'Importing tab-separated data: %s (%d rows deleted, %d inserted)'%(filename, deleted, inserted)
+		if indexchanged: modified = True
 
+	# remember imported files
+	cur.executemany('INSERT OR REPLACE INTO %s (filename, mtime, size, checksum, fields, lines) VALUES (?,?,?,?,?,?)'%srctable,
+		[(x,) + changed[x] + imported.get(x, (None, None)) for x in changed])
+	cur.execute('COMMIT')
+
+	# compact database after rebuild
+	if options.rebuild or createsql in changed:
+		print 'Compacting database'
+		cur.executescript('''
+			VACUUM;
+		''')
+	# compact index for fast lookups
+	if not options.index:
+		if os.path.exists(idx): os.unlink(idx)
+	elif modified or not os.path.exists(idx):
+		print 'Writing index'
+		write_index(con, idx)
+	con.close()
+	# database is up-to-date with its source files now, and index with database
+	os.utime(db, None)
+	if options.index: os.utime(idx, None)
+
+	print 'Done!'
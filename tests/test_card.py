@@ -0,0 +1,127 @@
+#
+# OV-chipkaart decoder: tests of card layouts
+#
+# Checks that the slots and header fields of OvcCard, which follow from
+# the LAYOUTS table, are those of the sector walk the decoder used before.
+# Run from the top directory with: python -m unittest discover tests
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License at http://www.gnu.org/licenses/gpl.txt
+# By using, editing and/or distributing this software you agree to
+# the terms and conditions of this license.
+#
+# (c)2010 by Willem van Engen <dev-rfid@willem.engen.nl>
+#
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ovc import *
+from ovc.util import mfclassic_getsector, getbits
+from ovc.synth import OvcSynth
+
+
+def sector_slots(data):
+	'''Return list of (address, data, record class) of non-empty slots,
+	walking the sectors of the card as the decoder used to'''
+	slots = []
+	if len(data) == 4096:
+		# transactions
+		for sector, slotsize in [(s, 0x30) for s in range(32, 35)] + [(s, 0x20) for s in range(35, 39)]:
+			base = 0x800 + (sector-32)*0x100
+			sdata = mfclassic_getsector(data, sector).tobytes()[:-0x10]
+			for chunk in range(0, len(sdata), slotsize):
+				if ord(sdata[chunk]) == 0: continue
+				slots.append((base+chunk, sdata[chunk:chunk+slotsize], OvcClassicTransaction))
+		# saldo
+		sdata = mfclassic_getsector(data, 39).tobytes()[:-0x10]
+		for chunk in [0x90, 0xa0]:
+			if ord(sdata[chunk]) == 0: continue
+			slots.append((0xf00+chunk, sdata[chunk:chunk+0x10], OvcSaldoTransaction))
+	else:
+		for chunk in range(0x10, len(data)-0x10, 0x10):
+			if data[chunk:chunk+2] == '\xff\xff': continue
+			slots.append((chunk, data[chunk:chunk+0x10], OvcULTransaction))
+	return slots
+
+def sector_header(data):
+	'''Return tuple of card id, card type, valid until and birth date,
+	decoded as the decoder used to'''
+	if len(data) != 4096: return None, None, None, None
+	cardid = getbits(data[0:4], 0, 4*8)
+	cardtype = OvcCardType(getbits(data[0x10:0x36], 18*8+4, 19*8))
+	validuntil = OvcDate(getbits(data[0x10:0x36], 11*8+6, 13*8+4))
+	birthdate = None
+	if cardtype == 2:
+		birthdate = OvcBcdDate(getbits(mfclassic_getsector(data, 22).tobytes(), 14*8, 18*8))
+	return cardid, cardtype, validuntil, birthdate
+
+def outcome(f):
+	'''Return result of f(), or ValueError when it raises one'''
+	try: return f()
+	except ValueError: return ValueError
+
+def card_header(data):
+	'''Return tuple of header fields of an OvcCard'''
+	card = OvcCard(data)
+	return card.cardid, card.cardtype, card.validuntil, card.birthdate
+
+
+class CardLayoutTest(unittest.TestCase):
+
+	def dumps(self, size):
+		'''Return dumps of size: synthetic cards, random data and blank cards'''
+		synth = OvcSynth(seed=size)
+		r = random.Random(size)
+		dumps = [synth.card(LAYOUTS[size]) for i in range(50)]
+		dumps += [''.join([chr(r.getrandbits(8)) for i in range(size)]) for i in range(10)]
+		dumps += ['\0'*size, '\xff'*size]
+		return dumps
+
+	def check_slots(self, size):
+		for data in self.dumps(size):
+			card = OvcCard(data)
+			slots = [(addr, sdata.tobytes(), cls) for addr, sdata, cls in card.slots()]
+			self.assertEqual(slots, sector_slots(data))
+			self.assertEqual([(r.__class__, r.data.tobytes()) for r in card.records()],
+			                 [(cls, sdata) for addr, sdata, cls in slots])
+
+	def test_classic_slots(self):
+		self.check_slots(4096)
+
+	def test_ultralight_slots(self):
+		self.check_slots(64)
+
+	def check_header(self, size):
+		headers = []
+		for data in self.dumps(size):
+			header = outcome(lambda: card_header(data))
+			self.assertEqual(header, outcome(lambda: sector_header(data)))
+			headers.append(header)
+		return headers
+
+	def test_classic_header(self):
+		headers = self.check_header(4096)
+		# personal cards with a birth date are among them
+		self.assertTrue([x for x in headers if x is not ValueError and x[3] is not None])
+
+	def test_ultralight_header(self):
+		self.check_header(64)
+
+	def test_size(self):
+		self.assertRaises(ValueError, OvcCard, '\0'*100)
+
+
+if __name__ == '__main__':
+	unittest.main()